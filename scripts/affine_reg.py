@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from nibabel import load, Nifti1Image
+from scipy.ndimage import gaussian_filter, map_coordinates, affine_transform
+from scipy.optimize import minimize
+
+N_CPU= 1
+
+# subsampling factors of the resolution levels, from coarse to fine
+LEVELS= (4, 2, 1)
+
+# typical distance in mm of a voxel to the center of the reference, the linear parameters are scaled by it
+# so that a unit step of any parameter moves voxels by about a mm
+RADIUS= 50.
+
+# L-BFGS iterations at each level
+MAX_ITER= 100
+
+# intensity bins of each image in the joint histogram of the mutual information
+BINS= 64
+
+
+def fsl_matrix(img):
+    '''
+    Matrix from voxel indices of img to FSL scaled mm coordinates, where the x axis is flipped
+    if the voxel to world matrix of img has a positive determinant
+    '''
+
+    zooms= np.array(img.header.get_zooms()[:3], dtype= float)
+    M= np.diag(np.append(zooms, 1))
+    if np.linalg.det(img.affine[:3, :3])>0:
+        M[0, 0]= -zooms[0]
+        M[0, 3]= (img.shape[0]-1)*zooms[0]
+
+    return M
+
+
+def _voxel_matrix(moving, reference, xfm):
+    '''Matrix from voxel indices of reference to those of moving, for a flirt matrix xfm from moving to reference'''
+
+    return np.linalg.inv(fsl_matrix(moving)) @ np.linalg.inv(xfm) @ fsl_matrix(reference)
+
+
+def _params_to_matrix(p, center):
+    '''
+    Matrix from reference to moving FSL coordinates,
+    x -> (I + L/RADIUS) (x - center) + center + t with p the 9 entries of L followed by t
+    '''
+
+    A= np.eye(3) + p[:9].reshape(3, 3)/RADIUS
+    M= np.eye(4)
+    M[:3, :3]= A
+    M[:3, 3]= center + p[9:] - A @ center
+
+    return M
+
+
+def _matrix_to_params(M, center):
+
+    A= M[:3, :3]
+    return np.concatenate([((A-np.eye(3))*RADIUS).ravel(), M[:3, 3] - center + A @ center])
+
+
+def _smooth(data, factor):
+
+    return gaussian_filter(data, factor/2) if factor>1 else data
+
+
+def _bins(values, bins=BINS):
+    '''Index of the bin of each value among bins of equal width over their range'''
+
+    lo, hi= values.min(), values.max()
+    if hi==lo:
+        return np.zeros(len(values), dtype= int)
+
+    return np.minimum(((values-lo)*(bins/(hi-lo))).astype(int), bins-1)
+
+
+def _bspline3(t):
+    '''Cubic B-spline at t and its derivative, the Parzen window of the moving intensities'''
+
+    a= np.abs(t)
+    near, far= a<1, (a>=1) & (a<2)
+    b= np.where(near, 2/3 - a*a + a**3/2, np.where(far, (2-a)**3/6, 0.))
+    db= np.sign(t)*np.where(near, 1.5*a*a - 2*a, np.where(far, -(2-a)**2/2, 0.))
+
+    return b, db
+
+
+class Reference(object):
+    '''
+    Reference image of registrations preprocessed once: at each resolution level, the FSL coordinates
+    of the masked voxels of a subsampled grid and the intensity bin of the smoothed reference there.
+    The mask is by default the voxels above the mean intensity.
+    '''
+
+    def __init__(self, img, mask=None, levels=LEVELS, bins=BINS):
+
+        self.img= img
+        self.fsl= fsl_matrix(img)
+        self.bins= bins
+        ref= np.asanyarray(img.dataobj, dtype= float)
+        if mask is None:
+            mask= ref>ref.mean()
+        self.center= self.fsl[:3, :3] @ ((np.array(ref.shape)-1)/2) + self.fsl[:3, 3]
+
+        self.levels= []
+        for factor in levels:
+            grid= (slice(None, None, factor),)*3
+            ind= np.nonzero(mask[grid]>0)
+            points= self.fsl[:3, :3] @ (np.array(ind, dtype= float)*factor) + self.fsl[:3, 3:]
+            self.levels.append((factor, points, _bins(_smooth(ref, factor)[grid][ind], bins)))
+
+
+def _moving_images(moving, factor, fsl_mov):
+    '''Smoothed moving image at a resolution level, and its gradient with respect to FSL coordinates'''
+
+    mov= _smooth(moving, factor)
+
+    # the axes of FSL coordinates are those of the voxels up to scale and flip
+    return [mov] + [g/fsl_mov[i, i] for i, g in enumerate(np.gradient(mov))]
+
+
+def _sample(images, coords):
+
+    return np.array([map_coordinates(img, coords, order= 1, mode= 'nearest') for img in images])
+
+
+class _Cost(object):
+    '''
+    Negative mutual information between the reference and the moving image over the mask, and its gradient.
+    The joint histogram counts the points in the fixed bin of their reference intensity, and in bins of the
+    moving intensity through a cubic B-spline window, so that it is smooth in the parameters (Mattes et al.
+    2003). Unlike a correlation, it does not assume the same contrast, such as from a B0 to a diffusion
+    weighted image, where CSF is bright then dark.
+    '''
+
+    def __init__(self, images, points, bins, nbins, center, fsl_mov, pool=None, ncpu=1):
+
+        self.images= images
+        self.points= points
+        self.bins= bins*nbins
+        self.nbins= nbins
+        self.center= center
+        self.vox_mov= np.linalg.inv(fsl_mov)
+        self.offsets= points-center[:, None]
+        self.map= pool.map if pool else map
+        self.chunks= np.array_split(np.arange(bins.size), ncpu)
+
+        # the window of any moving intensity is within the bins
+        self.low= images[0].min()
+        self.width= (images[0].max()-self.low)/(nbins-5)
+
+    def __call__(self, p):
+
+        if self.width==0:
+            return 0., np.zeros_like(p)
+
+        M= self.vox_mov @ _params_to_matrix(p, self.center)
+        coords= M[:3, :3] @ self.points + M[:3, 3:]
+
+        # each thread samples the moving image and its gradient at a chunk of the points
+        samples= np.concatenate(list(self.map(lambda ind: _sample(self.images, coords[:, ind]), self.chunks)),
+                                axis= 1)
+        m= (samples[0]-self.low)/self.width + 2
+        g= samples[1:]
+
+        # the four moving bins of the window of each point, and its weights there
+        j= np.floor(m).astype(int) + np.arange(-1, 3)[:, None]
+        w, dw= _bspline3(m-j)
+        ind= self.bins + j
+
+        n= m.size
+        joint= np.bincount(ind.ravel(), w.ravel(), self.nbins**2).reshape(self.nbins, self.nbins)/n
+        pm= joint.sum(0)
+        pr= joint.sum(1)
+        nz= joint>0
+        mi= joint[nz] @ np.log(joint[nz]/np.outer(pr, pm)[nz])
+
+        # derivative of the MI with respect to each sample, chained with that of the sample to the parameters
+        log= (np.log(np.where(nz, joint, 1)) - np.log(np.where(pm>0, pm, 1))).ravel()
+        gd= g*(-(dw*log[ind]).sum(0)/(n*self.width))
+        grad= np.concatenate([(gd @ self.offsets.T).ravel()/RADIUS, gd.sum(1)])
+
+        return -mi, grad
+
+
+def register(moving, reference, mask=None, init=None, levels=LEVELS, ncpu=N_CPU):
+    '''
+    Affine registration of the moving nibabel image to the reference one, maximizing the mutual information
+    over the mask of the reference (by default its voxels above the mean) with L-BFGS, from coarse to fine
+    resolution levels. reference may be a Reference shared by many registrations, then mask and levels
+    are those it was made with.
+
+    Returns the 4x4 matrix from moving to reference in FSL scaled mm coordinates, as flirt -omat,
+    starting from the flirt matrix init if given.
+    '''
+
+    if not isinstance(reference, Reference):
+        reference= Reference(reference, mask, levels)
+    fsl_mov= fsl_matrix(moving)
+    mov= np.asanyarray(moving.dataobj, dtype= float)
+    center= reference.center
+
+    p= _matrix_to_params(np.linalg.inv(init) if init is not None else np.eye(4), center)
+
+    pool= ThreadPool(ncpu) if ncpu>1 else None
+    try:
+        for factor, points, bins in reference.levels:
+            cost= _Cost(_moving_images(mov, factor, fsl_mov), points, bins, reference.bins, center, fsl_mov,
+                        pool, ncpu)
+            p= minimize(cost, p, jac= True, method= 'L-BFGS-B', options= dict(maxiter= MAX_ITER)).x
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return np.linalg.inv(_params_to_matrix(p, center))
+
+
+def apply_xfm(moving, reference, xfm, order=3):
+    '''Data of the moving nibabel image resampled on the grid of reference by the flirt matrix xfm'''
+
+    return affine_transform(np.asanyarray(moving.dataobj, dtype= float), _voxel_matrix(moving, reference, xfm),
+                            output_shape= reference.shape[:3], order= order, mode= 'nearest')
+
+
+def apply_xfms(dwi, reference, xfms, order=3, ncpu=N_CPU):
+    '''
+    All volumes of the 4D nibabel image dwi resampled on the grid of reference by the corresponding flirt matrices,
+    by a pool of threads into one preallocated float32 array
+    '''
+
+    data= np.asanyarray(dwi.dataobj)
+    out= np.empty(reference.shape[:3]+(len(xfms),), dtype= np.float32)
+
+    def _apply(i):
+        affine_transform(data[..., i].astype(np.float32), _voxel_matrix(dwi, reference, xfms[i]),
+                         output= out[..., i], order= order, mode= 'nearest')
+
+    pool= ThreadPool(ncpu)
+    pool.map(_apply, range(len(xfms)))
+    pool.close()
+    pool.join()
+
+    return out
+
+
+def main(args):
+
+    moving= load(args.input)
+    reference= load(args.ref)
+    mask= load(args.mask).get_fdata()>0 if args.mask else None
+    init= np.loadtxt(args.init) if args.init else None
+
+    xfm= register(moving, reference, mask, init, ncpu= args.ncpu)
+    np.savetxt(args.omat, xfm, fmt= '%.10f')
+
+    if args.out:
+        hdr= reference.header.copy()
+        hdr.set_data_dtype(np.float32)
+        Nifti1Image(apply_xfm(moving, reference, xfm).astype(np.float32), reference.affine, hdr).to_filename(args.out)
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+        description="""Affine registration with NumPy/SciPy, a replacement of FSL flirt for pnl_eddy.py.
+Maximizes the mutual information over a mask of the reference from coarse to fine resolution, and writes
+the transform as a flirt matrix""")
+
+    parser.add_argument('-i', '--input', required= True, help='moving image')
+    parser.add_argument('-r', '--ref', required= True, help='reference image')
+    parser.add_argument('--omat', required= True, help='output flirt matrix from input to reference')
+    parser.add_argument('-o', '--out', help='input registered to the reference, resampled with cubic B-splines')
+    parser.add_argument('--init', help='initial flirt matrix')
+    parser.add_argument('--mask', help='mask of the reference, default its voxels above the mean intensity')
+    parser.add_argument('--ncpu', default= N_CPU, type= int,
+                        help='number of threads evaluating the cost, default %(default)s')
+
+    args = parser.parse_args()
+
+    main(args)
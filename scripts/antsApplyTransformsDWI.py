@@ -1,19 +1,31 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory
+import sys
+from util import logfmt, TemporaryDirectory, load_nifti
 from plumbum import local, cli, FG
-from plumbum.cmd import WarpImageMultiTransform, fslsplit, fslmaths, fslmerge
+from nibabel import Nifti1Image
+from scipy.ndimage import map_coordinates
+import numpy as np
 
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+# ANTs displacement vectors are in LPS physical coordinates, NIfTI affines map voxels to RAS
+LPS= np.array([-1., -1., 1.])
+
+# largest displacement in voxels along the other axes of a warp along one axis, as --restrict-deformation 0x1x0 makes
+AXIS_TOLERANCE= 1e-4
 
 
 def _WarpImage(dwimask, vol, xfm):
 
+    from plumbum.cmd import WarpImageMultiTransform, fslmaths
+
     if dwimask:
-        fslmaths[vol, '-mas', dwimask, vol]
+        fslmaths(vol, '-mas', dwimask, vol)
 
     volwarped = vol.stem + '-warped.nii.gz'
     WarpImageMultiTransform('3', vol, volwarped, '-R', vol, xfm)
@@ -21,6 +33,110 @@ def _WarpImage(dwimask, vol, xfm):
     return volwarped
 
 
+def warp_coordinates(xfm, img):
+    '''
+    Voxel coordinates in img at which each voxel of img is sampled when warped by the ANTs displacement
+    field xfm with img as reference, as WarpImageMultiTransform -R img does, of shape (3,)+img.shape[:3]
+    '''
+
+    warp= load_nifti(xfm)
+    field= np.asanyarray(warp.dataobj, dtype= float).reshape(warp.shape[:3]+(3,))
+    shape= img.shape[:3]
+
+    vox= np.indices(shape, dtype= float).reshape(3, -1)
+    points= img.affine[:3, :3] @ vox + img.affine[:3, 3:]
+
+    # the field is sampled at the voxels of img, directly when both grids are the same
+    if field.shape[:3]==shape and np.allclose(warp.affine, img.affine):
+        disp= np.moveaxis(field, -1, 0).reshape(3, -1)
+    else:
+        inv= np.linalg.inv(warp.affine)
+        fvox= inv[:3, :3] @ points + inv[:3, 3:]
+        disp= np.array([map_coordinates(field[..., i], fvox, order= 1, mode= 'nearest') for i in range(3)])
+
+    inv= np.linalg.inv(img.affine)
+    points+= LPS[:, None]*disp
+
+    return (inv[:3, :3] @ points + inv[:3, 3:]).reshape((3,)+shape)
+
+
+def warp_volumes(data, coords, mask=None, order=1, ncpu=8):
+    '''
+    Every volume of the 4D data, multiplied by mask if given, interpolated at coords
+    by a pool of threads into one float32 array
+    '''
+
+    out= np.empty(coords.shape[1:]+(data.shape[3],), dtype= np.float32)
+
+    def _warp(i):
+        vol= data[..., i] if mask is None else data[..., i]*mask
+        map_coordinates(vol, coords, output= out[..., i], order= order, mode= 'constant')
+
+    pool= ThreadPool(ncpu)
+    pool.map(_warp, range(data.shape[3]))
+    pool.close()
+    pool.join()
+
+    return out
+
+
+def warp_axis(coords):
+    '''Voxel axis of a warp whose displacement is along that axis only, None if it is not'''
+
+    disp= np.array([np.abs(coords[i]-np.arange(n).reshape([-1 if j==i else 1 for j in range(3)])).max()
+                    for i, n in enumerate(coords.shape[1:])])
+    moved= np.nonzero(disp>AXIS_TOLERANCE)[0]
+
+    return int(np.argmax(disp)) if len(moved)<=1 else None
+
+
+def warp_volumes_1d(data, coords, axis, mask=None, ncpu=8):
+    '''
+    warp_volumes for a warp along one voxel axis: linear interpolation along that axis only,
+    vectorized over all the lines and volumes, by a pool of threads each on a slab across another axis
+    '''
+
+    n= data.shape[axis]
+    out= np.empty(data.shape, dtype= np.float32)
+
+    def _warp(slab):
+        x= coords[axis][slab]
+        i0= np.clip(np.floor(x), 0, n-2).astype(int)
+        w= (x-i0).astype(np.float32)
+        inside= ((x>=0) & (x<=n-1)).astype(np.float32)
+
+        # weights of the two neighbors along the axis, masked at the neighbors
+        w0, w1= (1-w)*inside, w*inside
+        if mask is not None:
+            m= mask[slab]
+            w0*= np.take_along_axis(m, i0, axis)
+            w1*= np.take_along_axis(m, i0+1, axis)
+
+        d= data[slab]
+        out[slab]= w0[..., None]*np.take_along_axis(d, i0[..., None], axis) + \
+                   w1[..., None]*np.take_along_axis(d, i0[..., None]+1, axis)
+
+    # slabs across an axis other than the warped one
+    across= 2 if axis!=2 else 0
+    slabs= [tuple(slice(s[0], s[-1]+1) if j==across else slice(None) for j in range(3))
+            for s in np.array_split(np.arange(data.shape[across]), min(data.shape[across], 4*ncpu)) if len(s)]
+
+    pool= ThreadPool(ncpu)
+    pool.map(_warp, slabs)
+    pool.close()
+    pool.join()
+
+    return out
+
+
+def warp_jacobian(coords):
+    '''Determinant of the Jacobian of the voxel coordinates sampled by a warp, for intensity modulation'''
+
+    jac= np.stack([np.stack(np.gradient(c), axis= -1) for c in coords], axis= -2)
+
+    return np.linalg.det(jac).astype(np.float32)
+
+
 class App(cli.Application):
     """Applies a transformation to a DWI nrrd, with option of masking first.
     (Used by epi.py)"""
@@ -30,14 +146,37 @@ class App(cli.Application):
     dwi = cli.SwitchAttr(
         ['-i', '--inpur'], cli.ExistingFile, help='DWI in nifti', mandatory=True)
     dwimask = cli.SwitchAttr(
-        ['--dwimask', '-m'], cli.ExistingFile, help='DWI mask in nifti', mandatory=False)
+        ['--dwimask', '-m'], cli.ExistingFile, help='DWI mask in nifti, for --outmask and --mask-first', mandatory=False)
+    mask_first = cli.Flag('--mask-first', default= False,
+        help='multiply each DWI volume by --dwimask before warping it, the DWI is warped unmasked otherwise')
     xfm = cli.SwitchAttr(['--transform', '-t'], cli.ExistingFile, help='transform', mandatory=True)
     out = cli.SwitchAttr(['-o', '--output'], cli.NonexistentPath, help='transformed DWI')
+    outmask = cli.SwitchAttr(['--outmask'],
+        help='DWI mask transformed with nearest neighbor interpolation, saved as uint8, overwritten if it exists')
     nproc = cli.SwitchAttr(
         ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer 
         becomes sluggish/you run into memory error, reduce --nproc''', default= 8)
+    engine = cli.SwitchAttr('--engine', cli.Set('ants', 'python'), default= 'ants',
+        help='''WarpImageMultiTransform on each volume, or in-process: the warp is read and the sampling
+        coordinates are computed once, then all the volumes are interpolated linearly by --nproc threads
+        into one 4D output, along one axis only if the warp is restricted to it''')
+    jacobian = cli.Flag('--jacobian', default= False,
+        help='multiply the warped volumes by the Jacobian determinant of the warp, --engine python only')
 
     def main(self):
+        if (self.outmask or self.mask_first) and not self.dwimask:
+            logging.error('--outmask and --mask-first require --dwimask')
+            sys.exit(1)
+        if self.outmask:
+            # relative to the working directory of the caller, not the temporary one
+            self.outmask = local.path(self.outmask)
+
+        if self.engine=='python':
+            self._warp_python()
+            return
+
+        from plumbum.cmd import fslsplit, fslmerge, WarpImageMultiTransform
+
         with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
             tmpdir = local.path(tmpdir)
             dicePrefix = 'vol'
@@ -52,7 +191,7 @@ class App(cli.Application):
             pool= Pool(int(self.nproc))
             res= []
             for vol in vols:
-                res.append(pool.apply_async(_WarpImage, (self.dwimask, vol, self.xfm)))
+                res.append(pool.apply_async(_WarpImage, (self.dwimask if self.mask_first else None, vol, self.xfm)))
 
             volsWarped= [r.get() for r in res]
             pool.close()
@@ -73,6 +212,11 @@ class App(cli.Application):
             volsWarped.sort()
             fslmerge['-t', self.out, volsWarped] & FG
 
+            if self.outmask:
+                from plumbum.cmd import fslmaths
+                WarpImageMultiTransform('3', self.dwimask, self.outmask, '-R', self.dwimask, self.xfm, '--use-NN')
+                fslmaths(self.outmask, '-mul', '1', self.outmask, '-odt', 'char')
+
 
             logging.info('Made ' + str(self.out))
 
@@ -83,6 +227,39 @@ class App(cli.Application):
                                ('antsApplyTransformsDWi-' + pid))
                 tmpdir.copy(d)
 
+    def _warp_python(self):
+
+        img= load_nifti(self.dwi._path)
+        mask= load_nifti(self.dwimask._path).get_fdata()>0 if self.dwimask else None
+
+        logging.info("Compute the sampling coordinates of the warp")
+        coords= warp_coordinates(self.xfm._path, img)
+
+        data= img.get_fdata(dtype= np.float32)
+        dwimask= mask if self.mask_first else None
+        axis= warp_axis(coords)
+        if axis is None:
+            logging.info("Apply warp to all DWI volumes")
+            warped= warp_volumes(data, coords, dwimask, ncpu= int(self.nproc))
+        else:
+            logging.info("Apply warp to all DWI volumes along axis {}".format(axis))
+            warped= warp_volumes_1d(data, coords, axis, dwimask, ncpu= int(self.nproc))
+
+        if self.jacobian:
+            warped*= warp_jacobian(coords)[..., None]
+
+        hdr= img.header.copy()
+        hdr.set_data_dtype(np.float32)
+        Nifti1Image(warped, img.affine, hdr).to_filename(self.out._path)
+
+        if self.outmask:
+            warped= map_coordinates(mask.astype(np.uint8), coords, order= 0, mode= 'constant')
+            hdr= img.header.copy()
+            hdr.set_data_dtype(np.uint8)
+            Nifti1Image(warped, img.affine, hdr).to_filename(self.outmask._path)
+
+        logging.info('Made ' + str(self.out))
+
 
 if __name__ == '__main__':
     App.run()
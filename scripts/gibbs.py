@@ -1,69 +1,558 @@
 # https://raw.githubusercontent.com/dipy/dipy/160b202e7cd0ed821e5e1bfc4cf14815700430f3/dipy/denoise/gibbs.py
 from __future__ import division, print_function, absolute_import
 
+import os
+from functools import partial
+
 import numpy as np
 
 
-def _image_tv(x, axis=0, n_points=3):
+class FFTBackend(object):
+    """ FFT functions used by the Gibbs removal kernels.
+
+    Parameters
+    ----------
+    name : str, optional
+        One of 'numpy' (single-threaded), 'scipy' (scipy.fft, threaded),
+        'pyfftw' (FFTW, threaded, with plan cache) or 'auto', which picks the
+        first of pyfftw, scipy and numpy that can be imported.
+        Default is set to 'numpy'.
+    workers : int, optional
+        Number of threads used by each transform. Ignored by numpy.
+        Default is set to 1.
+    wisdom : str, optional
+        File where FFTW wisdom is loaded from and saved to, so that FFTW
+        plans are only measured once per machine. Only used by pyfftw. The
+        wisdom is stored as arrays of bytes in an .npz file, read without
+        unpickling.
+
+    """
+
+    _functions = ('fft', 'ifft', 'rfft', 'irfft', 'fft2', 'ifft2', 'rfft2',
+                  'irfft2')
+
+    def __init__(self, name='numpy', workers=1, wisdom=None):
+        if name == 'auto':
+            for name in ('pyfftw', 'scipy', 'numpy'):
+                try:
+                    __import__(name)
+                    break
+                except ImportError:
+                    pass
+
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.wisdom = wisdom
+
+        if name == 'numpy':
+            module, kwargs = np.fft, {}
+        elif name == 'scipy':
+            import scipy.fft as module
+            kwargs = {'workers': self.workers}
+        elif name == 'pyfftw':
+            import pyfftw
+            from pyfftw.interfaces import numpy_fft as module, cache
+            cache.enable()
+            if wisdom and os.path.isfile(wisdom):
+                with np.load(wisdom, allow_pickle=False) as f:
+                    pyfftw.import_wisdom(tuple(f['arr_%d' % i].tobytes()
+                                               for i in range(len(f.files))))
+            self._saved = pyfftw.export_wisdom()
+            kwargs = {'threads': self.workers,
+                      'planner_effort': 'FFTW_MEASURE'}
+        else:
+            raise ValueError("Unknown FFT backend " + str(name))
+
+        for f in self._functions:
+            setattr(self, f, partial(getattr(module, f), **kwargs))
+
+    def save_wisdom(self):
+        """ Saves the FFTW plans measured so far to the wisdom file, if new
+        plans were measured since it was loaded or last saved. """
+        if self.name != 'pyfftw' or not self.wisdom:
+            return
+
+        import pyfftw
+        wisdom = pyfftw.export_wisdom()
+        if wisdom == self._saved:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.wisdom))
+        os.makedirs(directory, exist_ok=True)
+        tmp = self.wisdom + '.' + str(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, *[np.frombuffer(w, np.uint8) for w in wisdom])
+        os.replace(tmp, self.wisdom)
+        self._saved = wisdom
+
+
+# FFT backends keyed by their parameters, see get_fft_backend
+_BACKENDS = {}
+
+
+def get_fft_backend(name='numpy', workers=1, wisdom=None):
+    """ Returns a cached :class:`FFTBackend`, or name itself if it is one. """
+    if isinstance(name, FFTBackend):
+        return name
+
+    key = (name, workers, wisdom)
+    if key not in _BACKENDS:
+        _BACKENDS[key] = FFTBackend(name, workers, wisdom)
+
+    return _BACKENDS[key]
+
+
+class GibbsWorkspace(dict):
+    """ Buffers of the Gibbs removal kernels, allocated once and reused by
+    every slab of slices, and every line or shift of a slab.
+
+    Each buffer is identified by a name and a dtype, and holds as many points
+    as the largest shape it was requested with. Smaller shapes, such as the
+    last slab of a volume or the lines left by a mask, are views of its first
+    points. Buffers returned under the same name overwrite each other.
+
+    """
+
+    def empty(self, name, shape, dtype):
+        """ Uninitialized array of the given shape and dtype. """
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        key = (name, dtype)
+        if key not in self or self[key].size < size:
+            self[key] = np.empty(size, dtype)
+        return self[key][:size].reshape(shape)
+
+    def sub(self, name):
+        """ Workspace of its own for a nested call of a kernel. """
+        if name not in self:
+            self[name] = GibbsWorkspace()
+        return self[name]
+
+
+def _image_tv(x, axis=0, n_points=3, work=None):
     """ Computes total variation (TV) of matrix x across a given axis and
     along two directions.
 
     Parameters
     ----------
-    x : 2D ndarray
-        matrix x
+    x : 2D or 3D ndarray
+        matrix x or stack of matrices along its first axis
     axis : int (0 or 1)
-        Axis which TV will be calculated. Default a is set to 0.
+        Axis of each matrix along which TV will be calculated. Default a is
+        set to 0.
     n_points : int
         Number of points to be included in TV calculation.
+    work : GibbsWorkspace, optional
+        Buffers kept across calls. The returned arrays are then overwritten
+        by the next call.
 
     Returns
     -------
-    ptv : 2D ndarray
+    ptv : 2D or 3D ndarray
         Total variation calculated from the right neighbours of each point.
-    ntv : 2D ndarray
+    ntv : 2D or 3D ndarray
         Total variation calculated from the left neighbours of each point.
 
+    Notes
+    -----
+    The absolute differences between neighbours are computed once, with
+    wrap-around at the extreme points, and both TVs are sums of n_points
+    shifted views of them. The sums run in the same order as differences
+    computed for each neighbour, so results are bitwise identical.
+
     """
-    xs = x.copy() if axis else x.T.copy()
-
-    # Add copies of the data so that data extreme points are also analysed
-    xs = np.concatenate((xs[:, (-n_points-1):], xs, xs[:, 0:(n_points+1)]),
-                        axis=1)
-
-    ptv = np.absolute(xs[:, (n_points+1):(-n_points-1)] -
-                      xs[:, (n_points+2):(-n_points)])
-    ntv = np.absolute(xs[:, (n_points+1):(-n_points-1)] -
-                      xs[:, (n_points):(-n_points-2)])
-    for n in range(1, n_points):
-        ptv = ptv + np.absolute(xs[:, (n_points+1+n):(-n_points-1+n)] -
-                                xs[:, (n_points+2+n):(-n_points+n)])
-        ntv = ntv + np.absolute(xs[:, (n_points+1-n):(-n_points-1-n)] -
-                                xs[:, (n_points-n):(-n_points-2-n)])
+    xs = x if axis else np.swapaxes(x, -1, -2)
+    N = xs.shape[-1]
+    P = n_points
+
+    if work is None:
+        work = GibbsWorkspace()
+    d = work.empty('tv_d', xs.shape[:-1] + (N + 2*P - 1,), xs.dtype)
+    ptv = work.empty('tv_p', xs.shape, xs.dtype)
+    ntv = work.empty('tv_n', xs.shape, xs.dtype)
+
+    # d[..., P + i] is the absolute difference between points i + 1 and i,
+    # with P - 1 and P wrapped copies on the left and on the right
+    np.subtract(xs[..., 1:], xs[..., :-1], out=d[..., P:P+N-1])
+    np.subtract(xs[..., :1], xs[..., -1:], out=d[..., P+N-1:P+N])
+    np.absolute(d[..., P:P+N], out=d[..., P:P+N])
+    d[..., :P] = d[..., N:N+P]
+    d[..., N+P:] = d[..., P:2*P-1]
+
+    np.copyto(ptv, d[..., P:P+N])
+    np.copyto(ntv, d[..., P-1:P-1+N])
+    for n in range(1, P):
+        ptv += d[..., P+n:P+n+N]
+        ntv += d[..., P-1-n:P-1-n+N]
 
     if axis:
         return ptv, ntv
     else:
-        return ptv.T, ntv.T
+        return np.swapaxes(ptv, -1, -2), np.swapaxes(ntv, -1, -2)
+
+
+# Sub-voxel shifts searched by _gibbs_removal_1d
+_SSAMP = np.linspace(0.02, 0.9, num=45)
+
+# Phase ramps of _SSAMP keyed by line length, see _phase_ramps
+_RAMPS = {}
+
+
+def _phase_ramps(N, real_fft=False, dtype=np.complex128):
+    """ Phase ramps applying the sub-voxel shifts of _SSAMP to lines of
+    length N. They depend only on N so they are computed once and cached.
+
+    Parameters
+    ----------
+    N : int
+        Number of points of the lines to be shifted.
+    real_fft : bool, optional
+        If True, only return the N//2 + 1 frequencies of np.fft.rfft.
+    dtype : numpy dtype, optional
+        Complex precision of the ramps. Default is set to np.complex128.
+
+    Returns
+    -------
+    rp : 2D ndarray
+        Positive shift ramps, one row per shift, in np.fft.fft order.
+    rn : 2D ndarray
+        Negative shift ramps, one row per shift, in np.fft.fft order.
+
+    Notes
+    -----
+    Multiplying the fftshift-ed spectrum by exp(k*s) and fftshift-ing it back
+    only differs from multiplying the unshifted spectrum by these ramps by a
+    unit phase, which the magnitude taken afterwards removes.
+
+    """
+    key = (N, real_fft, np.dtype(dtype))
+    if key not in _RAMPS:
+        k = (2.0j * np.pi) * np.fft.fftfreq(N)
+        if real_fft:
+            k = k[:N//2 + 1]
+        rp = np.exp(np.outer(_SSAMP, k)).astype(dtype)
+        _RAMPS[key] = (rp, rp.conj())
+
+    return _RAMPS[key]
+
+
+def _shifted_magnitude(c, r, N, nyq=None, fft=None, out=None, work=None):
+    """ Magnitude of the lines of spectrum c once multiplied by ramps r.
+
+    Parameters
+    ----------
+    c : ndarray
+        Spectrum of the lines along the last axis, from np.fft.fft or, if it
+        has less than N points, from np.fft.rfft.
+    r : ndarray
+        Phase ramps broadcastable against c.
+    N : int
+        Number of points of the lines.
+    nyq : ndarray, optional
+        For the rfft spectrum of lines of even length, the imaginary part
+        that the Nyquist term contributes to the complex shifted lines.
+    out : ndarray, optional
+        Array where the magnitude is written.
+    work : GibbsWorkspace, optional
+        Buffer of the shifted spectrum.
+
+    Returns
+    -------
+    img : ndarray
+        Magnitude of the shifted lines.
+
+    Notes
+    -----
+    The ramps are Hermitian except at the Nyquist frequency, so for real
+    lines np.fft.irfft returns the real part of the complex result and the
+    Nyquist term alone adds a constant imaginary part to each line.
+
+    """
+    fft = fft or get_fft_backend()
+    cr = None
+    if work is not None:
+        cr = work.empty('cr', np.broadcast(c, r).shape, c.dtype)
+    cr = np.multiply(c, r, out=cr)
+    if c.shape[-1] == N:
+        return np.absolute(fft.ifft(cr), out=out)
+
+    img = fft.irfft(cr, n=N)
+    if out is None:
+        out = img
+    if nyq is None:
+        return np.absolute(img, out=out)
+
+    np.multiply(img, img, out=out)
+    out += nyq * nyq
+    return np.sqrt(out, out=out)
+
+
+def _update_shift(img, tvs, s, im, sh, tv, upd=None):
+    """ Keeps, for every point, the shifted image of lowest TV so far.
+
+    Parameters
+    ----------
+    img : ndarray
+        Images shifted by each of the shifts s, stacked along the first axis.
+    tvs : ndarray
+        TV of img.
+    s : 1D ndarray
+        Shifts of img.
+    im, sh, tv : ndarray
+        Current best image, shift and TV, updated in place.
+    upd : ndarray, optional
+        Boolean buffer of the shape of im for the points to update.
+
+    Notes
+    -----
+    The first of several equal TVs wins, as when shifts are tried one by one.
+
+    """
+    for j in range(len(s)):
+        upd = np.greater(tv, tvs[j], out=upd)
+        np.copyto(im, img[j], where=upd)
+        np.copyto(sh, s[j], where=upd)
+        np.copyto(tv, tvs[j], where=upd)
+
 
+def _tv_select(img, s, im, sh, tv, n_points):
+    """ Computes the TV of shifted lines and keeps, for every point, the
+    shifted line of lowest TV so far, in one pass over each line.
 
-def _gibbs_removal_1d(x, axis=0, n_points=3):
+    Same as :func:`_image_tv` followed by :func:`_update_shift`, with the
+    same order of operations so that results are bitwise identical. It is
+    meant to be compiled by numba, see :func:`_jit_tv_select`.
+
+    Parameters
+    ----------
+    img : 3D ndarray
+        Lines shifted by each of the shifts s, of shape (shifts, lines, N).
+    s : 1D ndarray
+        Shifts of img.
+    im, sh, tv : 2D ndarray
+        Current best lines, shift and TV, of shape (lines, N), updated in
+        place.
+    n_points : int
+        Number of points to be included in TV calculation.
+
+    """
+    K, L, N = img.shape
+    P = n_points
+    d = np.empty(N + 2*P - 1, img.dtype)
+    for j in range(K):
+        for m in range(L):
+            x = img[j, m]
+            for i in range(N - 1):
+                d[P + i] = abs(x[i + 1] - x[i])
+            d[P + N - 1] = abs(x[0] - x[N - 1])
+            for i in range(P):
+                d[i] = d[N + i]
+            for i in range(P - 1):
+                d[N + P + i] = d[P + i]
+
+            for i in range(N):
+                ptv = d[P + i]
+                ntv = d[P - 1 + i]
+                for n in range(1, P):
+                    ptv += d[P + n + i]
+                    ntv += d[P - 1 - n + i]
+                tvs = min(ptv, ntv)
+                if tv[m, i] > tvs:
+                    im[m, i] = x[i]
+                    sh[m, i] = s[j]
+                    tv[m, i] = tvs
+
+
+# Compiled kernels, see _jit_tv_select
+_JIT = {}
+
+
+def _jit_tv_select():
+    """ :func:`_tv_select` compiled by numba, or None if numba cannot be
+    imported. It is compiled on its first call for each dtype and cached on
+    disk for the next runs.
+
+    """
+    if 'tv_select' not in _JIT:
+        try:
+            from numba import njit
+            _JIT['tv_select'] = njit(cache=True, nogil=True)(_tv_select)
+        except ImportError:
+            _JIT['tv_select'] = None
+
+    return _JIT['tv_select']
+
+
+# Every _COARSE-th shift of _SSAMP, from 0.1 to 0.9 in steps of 0.1, is
+# evaluated by the coarse-to-fine search
+_COARSE = 5
+
+# Smallest curvature of the parabola through three TVs, relative to the best
+# one, for which the coarse-to-fine search refines the shift at its vertex
+_FLAT = 0.1
+
+
+class _CoarseSearch(object):
+    """ Coarse-to-fine sub-voxel shift search of _gibbs_removal_1d.
+
+    For every point, keeps the best shift of a uniform coarse grid together
+    with the TVs and images of its two neighbours on the grid. Shift zero is
+    the left neighbour of the first coarse shift. The shift is then refined
+    at the vertex of the parabola through the three TVs, and the image
+    interpolated linearly there between the best image and its neighbour on
+    the side of the vertex, so that it does not overshoot at sharp edges.
+    Where the three TVs are too close for the vertex to be meaningful, the
+    best shift of the grid and its image are kept.
+
+    Parameters
+    ----------
+    x : ndarray
+        Image at shift zero.
+    tv : ndarray
+        TV of x.
+    step : float
+        Spacing of the coarse grid, which starts at step.
+    work : GibbsWorkspace, optional
+        Buffers of the search.
+
+    """
+
+    def __init__(self, x, tv, step, work=None):
+        work = GibbsWorkspace() if work is None else work
+        self.step = step
+        self.k = work.empty('k', x.shape, np.int16)
+        self.k.fill(-1)
+        self.n = 0
+        self.prev = (work.empty('prev_im', x.shape, x.dtype),
+                     work.empty('prev_tv', tv.shape, tv.dtype))
+        np.copyto(self.prev[0], x)
+        np.copyto(self.prev[1], tv)
+        self.left = (work.empty('left_im', x.shape, x.dtype),
+                     work.empty('left_tv', tv.shape, tv.dtype))
+        self.right = (work.empty('right_im', x.shape, x.dtype),
+                      work.empty('right_tv', tv.shape, tv.dtype))
+        self.r = work.empty('r', x.shape, bool)
+        self.upd = work.empty('upd', x.shape, bool)
+
+    def update(self, img, tvs, s, im, sh, tv):
+        """ Same as :func:`_update_shift`, for consecutive coarse shifts. """
+        r, upd = self.r, self.upd
+        for j in range(len(s)):
+            # Points best at the previous shift get their right neighbour
+            np.equal(self.k, self.n - 1, out=r)
+            np.copyto(self.right[0], img[j], where=r)
+            np.copyto(self.right[1], tvs[j], where=r)
+
+            np.greater(tv, tvs[j], out=upd)
+            np.copyto(self.left[0], self.prev[0], where=upd)
+            np.copyto(self.left[1], self.prev[1], where=upd)
+            np.copyto(im, img[j], where=upd)
+            np.copyto(sh, s[j], where=upd)
+            np.copyto(tv, tvs[j], where=upd)
+            np.copyto(self.k, self.n, where=upd)
+
+            # img is overwritten by the next shifts
+            np.copyto(self.prev[0], img[j])
+            np.copyto(self.prev[1], tvs[j])
+            self.n += 1
+
+    def refine(self, im, sh, tv):
+        """ Refines the best coarse shifts sh and images im of TV tv. """
+        # The TV of the best shift is strictly lower than on its left and
+        # not higher than on its right, so the vertex lies within half a step
+        r = (self.k >= 0) & (self.k < self.n - 1)
+        yl, yb, yr = self.left[1][r], tv[r], self.right[1][r]
+        curv = yl - 2*yb + yr
+        t = (yl - yr) / (2 * curv)
+        t[curv <= _FLAT * yb] = 0
+
+        il, ib, ir = self.left[0][r], im[r], self.right[0][r]
+        im[r] = ib + np.abs(t) * (np.where(t > 0, ir, il) - ib)
+        sh[r] += t * self.step
+
+
+def _to_process(x, mask=None, skip_constant=False, naxes=1):
+    """ Finds the lines or images of x that Gibbs removal has to process.
+
+    Parameters
+    ----------
+    x : ndarray
+        Lines along the last axis (naxes=1) or images along the last two
+        axes (naxes=2).
+    mask : ndarray, optional
+        Boolean array of the shape of x. Lines or images without any point
+        in the mask are not processed.
+    skip_constant : bool, optional
+        If True, lines or images with a single value, such as the background
+        of the field of view or zero-padding slices, are not processed.
+    naxes : int (1 or 2)
+        Number of trailing axes of x forming a line or an image.
+
+    Returns
+    -------
+    keep : ndarray or None
+        Boolean array of the lines or images to process, None if all of
+        them have to be.
+
+    """
+    axes = tuple(range(-naxes, 0))
+    keep = np.ones(x.shape[:x.ndim - naxes], dtype=bool)
+    if mask is not None:
+        keep &= np.any(mask, axis=axes)
+    if skip_constant:
+        keep &= np.any(x != x[(Ellipsis,) + (slice(0, 1),) * naxes], axis=axes)
+
+    return None if keep.all() else keep
+
+
+def _gibbs_removal_1d(x, axis=0, n_points=3, shift_chunk=1, real_fft=False,
+                      fft=None, mask=None, skip_constant=False,
+                      coarse_to_fine=False, jit=False, work=None):
     """Suppresses Gibbs ringing along a given axis using fourier sub-shifts.
 
     Parameters
     ----------
-    x : 2D ndarray
-        Matrix x.
+    x : 2D or 3D ndarray
+        Matrix x or stack of matrices along its first axis.
     axis : int (0 or 1)
-        Axis in which Gibbs oscillations will be suppressed.
+        Axis of each matrix in which Gibbs oscillations will be suppressed.
         Default is set to 0.
     n_points : int, optional
         Number of neighbours to access local TV (see note).
         Default is set to 3.
+    shift_chunk : int, optional
+        Number of sub-voxel shifts evaluated together as one stacked array
+        operation. Memory grows linearly with it. Default is set to 1.
+    real_fft : bool, optional
+        If True, use real-input FFTs, which halve the spectral work and
+        memory. Default is set to False.
+    fft : FFTBackend, optional
+        FFT functions to use. Default is numpy.fft.
+    mask : 2D or 3D ndarray, optional
+        Boolean array of the shape of x. Lines along the given axis without
+        any point in the mask are left unchanged.
+    skip_constant : bool, optional
+        If True, lines along the given axis with a single value are left
+        unchanged without being processed. They would not be changed anyway
+        as no sub-voxel shift can lower their zero TV. Default is set to
+        False.
+    coarse_to_fine : bool, optional
+        If True, only evaluate the shifts 0.1, 0.2, ..., 0.9 and refine the
+        best one of each point by parabolic interpolation, see
+        :class:`_CoarseSearch`, instead of evaluating all 45 shifts.
+        Default is set to False.
+    jit : bool, optional
+        If True and numba is installed, compute the TV of each shift and
+        update the best shifts in one compiled pass, see :func:`_tv_select`.
+        Not used by the coarse-to-fine search. Default is set to False.
+    work : GibbsWorkspace, optional
+        Buffers reused across calls. The returned matrix is then one of them,
+        overwritten by the next call along the same axis.
 
     Returns
     -------
-    xc : 2D ndarray
+    xc : 2D or 3D ndarray
         Matrix with suppressed Gibbs oscillations along the given axis.
 
     Notes
@@ -75,53 +564,119 @@ def _gibbs_removal_1d(x, axis=0, n_points=3):
     considered in TV calculation can be adjusted using the parameter n_points.
 
     """
-    ssamp = np.linspace(0.02, 0.9, num=45)
+    ssamp = _SSAMP
+    work = GibbsWorkspace() if work is None else work
+    xv = x if axis else np.swapaxes(x, -1, -2)
+
+    # Only process the lines that need it, as a stack of lines
+    if mask is not None and not axis:
+        mask = np.swapaxes(mask, -1, -2)
+    keep = _to_process(xv, mask, skip_constant)
+    if keep is not None:
+        xs = xv.copy()
+        if keep.any():
+            xs[keep] = _gibbs_removal_1d(xs[keep], axis=1, n_points=n_points,
+                                         shift_chunk=shift_chunk,
+                                         real_fft=real_fft, fft=fft,
+                                         coarse_to_fine=coarse_to_fine,
+                                         jit=jit, work=work.sub('kept'))
+        return xs if axis else np.swapaxes(xs, -1, -2)
 
-    xs = x.copy() if axis else x.T.copy()
+    shape, dtype = xv.shape, xv.dtype
+    xs = work.empty(('xs', axis), shape, dtype)
+    np.copyto(xs, xv)
 
     # TV for shift zero (baseline)
-    tvr, tvl = _image_tv(xs, axis=1, n_points=n_points)
-    tvp = np.minimum(tvr, tvl)
-    tvn = tvp.copy()
+    tvr, tvl = _image_tv(xs, axis=1, n_points=n_points, work=work)
+    tvp = np.minimum(tvr, tvl, out=work.empty('tvp', shape, dtype))
+    tvn = work.empty('tvn', shape, dtype)
+    np.copyto(tvn, tvp)
 
     # Find optimal shift for gibbs removal
-    isp = xs.copy()
-    isn = xs.copy()
-    sp = np.zeros(xs.shape)
-    sn = np.zeros(xs.shape)
-    N = xs.shape[1]
-    c = np.fft.fftshift(np.fft.fft2(xs))
-    k = np.linspace(-N/2, N/2-1, num=N)
-    k = (2.0j * np.pi * k) / N
-    for s in ssamp:
-        # Access positive shift for given s
-        img_p = abs(np.fft.ifft2(np.fft.fftshift(c * np.exp(k*s))))
-        tvsr, tvsl = _image_tv(img_p, axis=1, n_points=n_points)
-        tvs_p = np.minimum(tvsr, tvsl)
-
-        # Access negative shift for given s
-        img_n = abs(np.fft.ifft2(np.fft.fftshift(c * np.exp(-k*s))))
-        tvsr, tvsl = _image_tv(img_n, axis=1, n_points=n_points)
-        tvs_n = np.minimum(tvsr, tvsl)
+    isp = work.empty('isp', shape, dtype)
+    isn = work.empty('isn', shape, dtype)
+    np.copyto(isp, xs)
+    np.copyto(isn, xs)
+    sp = work.empty('sp', shape, dtype)
+    sn = work.empty('sn', shape, dtype)
+    sp.fill(0)
+    sn.fill(0)
+    upd = work.empty('upd', shape, bool)
+    N = shape[-1]
+    fft = fft or get_fft_backend()
+    cdtype = np.result_type(dtype, np.complex64)
+    c = fft.rfft(xs, axis=-1) if real_fft else fft.fft(xs, axis=-1)
+    c = c.astype(cdtype, copy=False)
+    rp, rn = _phase_ramps(N, real_fft, cdtype)
+    bshape = (-1,) + (1,) * (xs.ndim - 1) + (rp.shape[-1],)
+
+    shifts = np.arange(len(ssamp))
+    if coarse_to_fine:
+        shifts = shifts[_COARSE-1::_COARSE]
+        step = ssamp[shifts[0]]
+        search_p = _CoarseSearch(xs, tvp, step, work.sub('coarse_p'))
+        search_n = _CoarseSearch(xs, tvn, step, work.sub('coarse_n'))
+
+    select = _jit_tv_select() if jit and not coarse_to_fine else None
+
+    shift_chunk = max(1, int(shift_chunk))
+    for i in range(0, len(shifts), shift_chunk):
+        si = shifts[i:i+shift_chunk]
+        s = ssamp[si]
+        sshape = (len(si),) + shape
+
+        # Imaginary part left by the Nyquist term of the real spectrum
+        nyq = None
+        if real_fft and N % 2 == 0:
+            nyq = c[..., -1:].real / N * \
+                np.sin(np.pi * s).astype(dtype).reshape(bshape[:-1] + (1,))
+
+        # Access positive and negative shifts for given s
+        img_p = _shifted_magnitude(c, rp[si].reshape(bshape), N, nyq, fft,
+                                   work.empty('img_p', sshape, dtype), work)
+        img_n = _shifted_magnitude(c, rn[si].reshape(bshape), N, nyq, fft,
+                                   work.empty('img_n', sshape, dtype), work)
+
+        if select is not None:
+            lines = (len(si), -1, N)
+            select(img_p.reshape(lines), s, isp.reshape(lines[1:]),
+                   sp.reshape(lines[1:]), tvp.reshape(lines[1:]), n_points)
+            select(img_n.reshape(lines), s, isn.reshape(lines[1:]),
+                   sn.reshape(lines[1:]), tvn.reshape(lines[1:]), n_points)
+            continue
+
+        tvsr, tvsl = _image_tv(img_p, axis=1, n_points=n_points, work=work)
+        tvs_p = np.minimum(tvsr, tvsl, out=work.empty('tvs_p', sshape, dtype))
+        tvsr, tvsl = _image_tv(img_n, axis=1, n_points=n_points, work=work)
+        tvs_n = np.minimum(tvsr, tvsl, out=work.empty('tvs_n', sshape, dtype))
+
+        if coarse_to_fine:
+            search_p.update(img_p, tvs_p, s, isp, sp, tvp)
+            search_n.update(img_n, tvs_n, s, isn, sn, tvn)
+            continue
 
         # Update positive shift params
-        isp[tvp > tvs_p] = img_p[tvp > tvs_p]
-        sp[tvp > tvs_p] = s
-        tvp[tvp > tvs_p] = tvs_p[tvp > tvs_p]
+        _update_shift(img_p, tvs_p, s, isp, sp, tvp, upd)
 
         # Update negative shift params
-        isn[tvn > tvs_n] = img_n[tvn > tvs_n]
-        sn[tvn > tvs_n] = s
-        tvn[tvn > tvs_n] = tvs_n[tvn > tvs_n]
+        _update_shift(img_n, tvs_n, s, isn, sn, tvn, upd)
+
+    if coarse_to_fine:
+        search_p.refine(isp, sp, tvp)
+        search_n.refine(isn, sn, tvn)
 
     # check non-zero sub-voxel shifts
-    idx = np.nonzero(sp + sn)
+    den = np.add(sp, sn, out=work.empty('den', shape, dtype))
+    nz = np.not_equal(den, 0, out=upd)
 
     # use positive and negative optimal sub-voxel shifts to interpolate to
     # original grid points
-    xs[idx] = (isp[idx] - isn[idx])/(sp[idx] + sn[idx])*sn[idx] + isn[idx]
+    np.subtract(isp, isn, out=xs, where=nz)
+    np.divide(xs, den, out=xs, where=nz)
+    np.multiply(xs, sn, out=xs, where=nz)
+    np.add(xs, isn, out=xs, where=nz)
 
-    return xs if axis else xs.T
+    return xs if axis else np.swapaxes(xs, -1, -2)
 
 
 def _weights(shape):
@@ -168,13 +723,47 @@ def _weights(shape):
     return G0, G1
 
 
-def _gibbs_removal_2d(image, n_points=3, G0=None, G1=None):
-    """ Suppress Gibbs ringing of a 2D image.
+def _half_weights(G):
+    """ Splits weights for fftshift-ed spectra into the parts that are even
+    and odd under a change of sign of the frequency, restricted to the half
+    spectrum of np.fft.rfft2.
 
     Parameters
     ----------
-    image : 2D ndarray
-        Matrix containing the 2D image.
+    G : 2D ndarray
+        Weights from :func:`_weights`.
+
+    Returns
+    -------
+    E : 2D ndarray
+        Even part of the weights.
+    O : 2D ndarray
+        Odd part of the weights.
+
+    Notes
+    -----
+    For a real image, the even part keeps its spectrum Hermitian and the odd
+    part makes it anti-Hermitian, so that weighting contributes the real and
+    the imaginary part of the complex inverse transform respectively.
+
+    """
+    W = np.fft.ifftshift(G)
+    Wm = np.roll(W[::-1, ::-1], 1, axis=(0, 1))
+    n = G.shape[1]//2 + 1
+
+    return ((W + Wm)/2)[:, :n], ((W - Wm)/2)[:, :n]
+
+
+def _gibbs_removal_2d(image, n_points=3, G0=None, G1=None, shift_chunk=1,
+                      real_fft=False, fft=None, mask=None, skip_constant=False,
+                      coarse_to_fine=False, jit=False, work=None):
+    """ Suppress Gibbs ringing of a 2D image or of a stack of 2D images.
+
+    Parameters
+    ----------
+    image : 2D or 3D ndarray
+        Matrix containing the 2D image, or a stack of 2D images along its
+        first axis. All images of a stack are processed at once.
     n_points : int, optional
         Number of neighbours to access local TV (see note). Default is
         set to 3.
@@ -184,10 +773,32 @@ def _gibbs_removal_2d(image, n_points=3, G0=None, G1=None):
     G1 : 2D ndarray
         Weights for the image corrected along axis 1. If not given, the
         function estimates them using the function :func:`_weights`.
+    shift_chunk : int, optional
+        Number of sub-voxel shifts evaluated together, see
+        :func:`_gibbs_removal_1d`. Default is set to 1.
+    real_fft : bool, optional
+        If True, use real-input FFTs, see :func:`_gibbs_removal_1d`.
+        Default is set to False.
+    fft : FFTBackend, optional
+        FFT functions to use. Default is numpy.fft.
+    mask : 2D or 3D ndarray, optional
+        Boolean array of the shape of image. Images, and lines of the
+        images, without any point in the mask are left unchanged.
+    skip_constant : bool, optional
+        If True, images and lines with a single value are left unchanged
+        without being processed. Default is set to False.
+    coarse_to_fine : bool, optional
+        If True, use the coarse-to-fine shift search, see
+        :func:`_gibbs_removal_1d`. Default is set to False.
+    jit : bool, optional
+        If True, use the numba compiled TV and shift selection, see
+        :func:`_gibbs_removal_1d`. Default is set to False.
+    work : GibbsWorkspace, optional
+        Buffers reused across calls, see :func:`_gibbs_removal_1d`.
 
     Returns
     -------
-    imagec : 2D ndarray
+    imagec : 2D or 3D ndarray
         Matrix with Gibbs oscillations reduced along axis a.
 
     Notes
@@ -211,31 +822,130 @@ def _gibbs_removal_2d(image, n_points=3, G0=None, G1=None):
 
     """
     if np.any(G0) is None or np.any(G1) is None:
-        G0, G1 = _weights(image.shape)
+        G0, G1 = _weights(image.shape[-2:])
 
-    img_c1 = _gibbs_removal_1d(image, axis=1, n_points=n_points)
-    img_c0 = _gibbs_removal_1d(image, axis=0, n_points=n_points)
+    # Only process the images that need it
+    keep = _to_process(image, mask, skip_constant, naxes=2)
+    if keep is not None:
+        imagec = image.copy()
+        if keep.any():
+            imagec[keep] = _gibbs_removal_2d(
+                image[keep], n_points=n_points, G0=G0, G1=G1,
+                shift_chunk=shift_chunk, real_fft=real_fft, fft=fft,
+                mask=None if mask is None else mask[keep],
+                skip_constant=skip_constant, coarse_to_fine=coarse_to_fine,
+                jit=jit, work=work)
+        return imagec
 
-    C1 = np.fft.fft2(img_c1)
-    C0 = np.fft.fft2(img_c0)
-    imagec = abs(np.fft.ifft2(np.fft.fftshift(C1)*G1 + np.fft.fftshift(C0)*G0))
+    fft = fft or get_fft_backend()
+    work = GibbsWorkspace() if work is None else work
+    img_c1 = _gibbs_removal_1d(image, axis=1, n_points=n_points,
+                               shift_chunk=shift_chunk, real_fft=real_fft,
+                               fft=fft, mask=mask, skip_constant=skip_constant,
+                               coarse_to_fine=coarse_to_fine, jit=jit,
+                               work=work)
+    img_c0 = _gibbs_removal_1d(image, axis=0, n_points=n_points,
+                               shift_chunk=shift_chunk, real_fft=real_fft,
+                               fft=fft, mask=mask, skip_constant=skip_constant,
+                               coarse_to_fine=coarse_to_fine, jit=jit,
+                               work=work)
+
+    if real_fft:
+        E0, O0 = _half_weights(G0)
+        E1, O1 = _half_weights(G1)
+        C1 = fft.rfft2(img_c1)
+        C0 = fft.rfft2(img_c0)
+        shape = image.shape[-2:]
+        return np.hypot(fft.irfft2(C1*E1 + C0*E0, s=shape),
+                        fft.irfft2(-1j*(C1*O1 + C0*O0), s=shape))
+
+    C1 = fft.fft2(img_c1)
+    C0 = fft.fft2(img_c0)
+    imagec = abs(fft.ifft2(np.fft.fftshift(C1, axes=(-2, -1))*G1 +
+                              np.fft.fftshift(C0, axes=(-2, -1))*G0))
 
     return imagec
 
 
-def gibbs_removal(vol, slice_axis=2, n_points=3):
+def gibbs_removal(vol, slice_axis=2, n_points=3, slab_size=16, shift_chunk=1,
+                  real_fft=False, fft_backend='numpy', workers=1, mask=None,
+                  skip_constant=False, dtype=np.float64, out=None,
+                  coarse_to_fine=False, jit=False, workspace=None):
     """Suppresses Gibbs ringing artefacts of images volumes.
 
     Parameters
     ----------
     vol : ndarray ([X, Y]), ([X, Y, Z]) or ([X, Y, Z, g])
         Matrix containing one volume (3D) or multiple (4D) volumes of images.
+        It is only read one slab of slices at a time, so it can also be a
+        memory map or a nibabel array proxy (``img.dataobj``).
     slice_axis : int (0, 1, or 2)
         Data axis corresponding to the number of acquired slices.
         Default is set to the third axis.
     n_points : int, optional
         Number of neighbour points to access local TV (see note).
         Default is set to 3.
+    slab_size : int, optional
+        Number of slices processed together by the FFT engine. Larger slabs
+        reduce Python overhead while peak memory grows linearly with them.
+        Default is set to 16.
+    shift_chunk : int, optional
+        Number of the 45 sub-voxel shifts evaluated together as one stacked
+        array operation. Peak memory grows linearly with it. Default is set
+        to 1.
+    real_fft : bool, optional
+        If True, use real-input (rfft) transforms for the shift search and
+        for the recombination of both axes. This halves the FFT work and the
+        spectral memory, the result matches the complex path up to rounding.
+        Default is set to False.
+    fft_backend : str or FFTBackend, optional
+        FFT implementation, one of 'numpy', 'scipy', 'pyfftw' or 'auto', see
+        :class:`FFTBackend`. Default is set to 'numpy'.
+    workers : int, optional
+        Number of threads of each FFT, used by the scipy and pyfftw backends.
+        Default is set to 1.
+    mask : ndarray ([X, Y]) or ([X, Y, Z]), optional
+        Boolean mask of the image (3D) or of each volume (4D). Slices, and
+        lines of the slices, without any point in the mask are passed
+        through unchanged. Unlike skip_constant, this changes the result
+        inside the mask too: both axes of a slice are recombined in Fourier
+        space, so every point depends on the lines left unprocessed. On a
+        ringing phantom, points inside a head mask differ by up to about
+        0.2% of the maximum intensity. Use skip_constant for identical
+        output.
+    skip_constant : bool, optional
+        If True, slices and lines with a single value, such as the all-zero
+        field of view outside the head or zero-padding slices, are passed
+        through unchanged without being processed. This does not change the
+        result. Default is set to False.
+    dtype : numpy dtype, optional
+        Floating point precision of the computations. np.float32 halves the
+        memory of every intermediate array and speeds up the transforms, at
+        the cost of rounding errors (see Notes). Default is set to
+        np.float64.
+    out : ndarray, optional
+        Array of the shape of vol, possibly memory-mapped, where the
+        corrected slabs are written as they are computed. Default is vol
+        itself if it is a writable floating point 3D or 4D ndarray, a new
+        array of dtype otherwise.
+    coarse_to_fine : bool, optional
+        If True, only evaluate 9 of the 45 sub-voxel shifts, 0.1 to 0.9 in
+        steps of 0.1, and refine the best one of each point by parabolic
+        interpolation of the TV. This halves the run time. On ringing
+        phantoms, differences to the exhaustive search relative to the
+        maximum intensity are below 0.3% for 99% of the points and 1.2% for
+        99.9% of them, but reach 7% at a few points near sharp edges, where
+        the coarse grid misses the narrow minimum of the TV that the
+        exhaustive search selects. Default is set to False.
+    jit : bool, optional
+        If True and numba is installed, compute the TV of each sub-voxel
+        shift and keep the best shifts in one compiled pass over the shifted
+        images instead of several NumPy passes. The result is identical.
+        Without numba, NumPy is used. Default is set to False.
+    workspace : GibbsWorkspace, optional
+        Buffers of the computations, allocated by the first slab and reused
+        by the next ones. Passing the same workspace to several calls reuses
+        them across calls too. A new one is used by default.
 
     Returns
     -------
@@ -248,6 +958,11 @@ def gibbs_removal(vol, slice_axis=2, n_points=3):
     For 4D matrix last element should always correspond to the number of
     diffusion gradient directions.
 
+    In single precision, errors relative to the maximum intensity are
+    typically 1e-7. Points where two sub-voxel shifts give TVs closer than
+    the rounding error may select a different shift than in double
+    precision, so about 1 in 10000 points differ by more than 1e-4.
+
     References
     ----------
     Please cite the following articles
@@ -267,37 +982,70 @@ def gibbs_removal(vol, slice_axis=2, n_points=3):
         raise ValueError("Different slices have to be organized along" +
                          "one of the 3 first matrix dimensions")
 
-    # 2) If this is not 2, swap axes so that different slices are ordered
-    # along axis 2. Note that swapping is not required if data is already a
-    # single image
-    elif slice_axis < 2 and nd > 2:
-        vol = np.swapaxes(vol, slice_axis, 2)
-
     # check matrix dimension
-    if nd == 4:
-        inishap = vol.shape
-        vol = vol.reshape((inishap[0], inishap[1], inishap[2] * inishap[3]))
-    elif nd > 4:
+    if nd > 4:
         raise ValueError("Data have to be a 4D, 3D or 2D matrix")
     elif nd < 2:
         raise ValueError("Data is not an image")
 
+    if out is None:
+        if (nd > 2 and isinstance(vol, np.ndarray) and vol.flags.writeable
+                and np.issubdtype(vol.dtype, np.floating)):
+            out = vol
+        else:
+            out = np.empty(vol.shape, dtype=dtype)
+
+    fft = get_fft_backend(fft_backend, workers)
+
     # Produce weigthing functions for 2D Gibbs removal
     shap = vol.shape
-    G0, G1 = _weights(shap[:2])
+    dtype = np.dtype(dtype)
+    if nd == 2:
+        G0, G1 = _weights(shap)
+    else:
+        G0, G1 = _weights([n for i, n in enumerate(shap[:3])
+                           if i != slice_axis])
+    G0, G1 = G0.astype(dtype), G1.astype(dtype)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    if workspace is None:
+        workspace = GibbsWorkspace()
 
-    # Run Gibbs removal of 2D images
+    # Run Gibbs removal of 2D images, a slab of slices of a volume at a time.
+    # Slices are moved to the first axis so that a slab is a stack of images.
     if nd == 2:
-        vol = _gibbs_removal_2d(vol, n_points=n_points, G0=G0, G1=G1)
+        out[...] = _gibbs_removal_2d(np.asarray(vol, dtype=dtype),
+                                     n_points=n_points, G0=G0, G1=G1,
+                                     shift_chunk=shift_chunk,
+                                     real_fft=real_fft, fft=fft, mask=mask,
+                                     skip_constant=skip_constant,
+                                     coarse_to_fine=coarse_to_fine,
+                                     jit=jit, work=workspace)
     else:
-        for vi in range(shap[2]):
-            vol[:, :, vi] = _gibbs_removal_2d(vol[:, :, vi], n_points=n_points,
-                                              G0=G0, G1=G1)
+        slab_size = max(1, int(slab_size))
+        for vi in range(shap[3] if nd == 4 else 1):
+            for si in range(0, shap[slice_axis], slab_size):
+                idx = [slice(None)] * 3
+                idx[slice_axis] = slice(si, si+slab_size)
+                slab_mask = None
+                if mask is not None:
+                    slab_mask = np.moveaxis(mask[tuple(idx)], slice_axis, 0)
+                if nd == 4:
+                    idx.append(vi)
+                idx = tuple(idx)
+
+                slab = np.moveaxis(np.asarray(vol[idx], dtype=dtype),
+                                   slice_axis, 0)
+                slab = _gibbs_removal_2d(slab, n_points=n_points, G0=G0,
+                                         G1=G1, shift_chunk=shift_chunk,
+                                         real_fft=real_fft, fft=fft,
+                                         mask=slab_mask,
+                                         skip_constant=skip_constant,
+                                         coarse_to_fine=coarse_to_fine,
+                                         jit=jit, work=workspace)
+                out[idx] = np.moveaxis(slab, 0, slice_axis)
 
-    # Reshape data to original format
-    if nd == 4:
-        vol = vol.reshape(inishap)
-    if slice_axis < 2 and nd > 2:
-        vol = np.swapaxes(vol, slice_axis, 2)
+    # Keep FFTW plans measured for these shapes for the next runs
+    fft.save_wisdom()
 
-    return vol
+    return out
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from os.path import abspath, dirname, join as pjoin
+from gibbs import gibbs_removal, get_fft_backend, _image_tv, _gibbs_removal_1d, _weights
+
+# result of the original DIPY gibbs_removal on a 32x32x8 phantom of 2 volumes
+REFERENCE= pjoin(dirname(abspath(__file__)), 'gibbs_reference.npz')
+
+
+def ringing_phantom(shape, volumes=1, seed=0):
+    '''
+    Synthetic DWI-like data with Gibbs ringing: nested ellipsoids whose slices are truncated in k-space,
+    attenuated differently in each volume, with Rician-like noise and a zero-padded border
+    '''
+
+    rng= np.random.default_rng(seed)
+    X, Y, Z= shape
+    x, y, z= np.meshgrid(np.linspace(-1, 1, X), np.linspace(-1, 1, Y), np.linspace(-1, 1, Z), indexing='ij')
+
+    head= (x/0.8)**2 + (y/0.9)**2 + (z/0.85)**2 < 1
+    brain= (x/0.7)**2 + (y/0.8)**2 + (z/0.75)**2 < 1
+    ventricles= ((x/0.15)**2 + (y/0.3)**2 + (z/0.3)**2 < 1)
+
+    # b0 then diffusion weighted volumes, attenuating tissues differently
+    data= np.zeros(shape+(volumes,))
+    for g in range(volumes):
+        if g==0:
+            tissue, csf= 1, 2
+        else:
+            tissue, csf= 0.3+0.2*rng.random(), 0.05
+        img= 500*(0.4*head + tissue*brain + csf*ventricles)
+
+        # keep the central half of k-space of each slice to make it ring
+        k= np.fft.fftshift(np.fft.fft2(img, axes=(0, 1)), axes=(0, 1))
+        keep= np.zeros((X, Y), dtype=bool)
+        keep[X//4:X-X//4, Y//4:Y-Y//4]= True
+        img= np.fft.ifft2(np.fft.ifftshift(k*keep[..., None], axes=(0, 1)), axes=(0, 1))
+
+        noise= rng.normal(0, 5, img.shape) + 1j*rng.normal(0, 5, img.shape)
+        data[..., g]= abs(img+noise)
+
+    # zero-padded field of view and slices
+    data[:2]= data[-2:]= 0
+    data[:, :, :1]= data[:, :, -1:]= 0
+
+    return data
+
+
+def _timed(func, *args, repeat=1, **kwargs):
+    '''Best wall time of repeat calls, peak traced memory of one call, and the result'''
+
+    best= np.inf
+    for _ in range(repeat):
+        start= time.perf_counter()
+        res= func(*args, **kwargs)
+        best= min(best, time.perf_counter()-start)
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak= tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak, res
+
+
+def benchmark_kernels(data, options, repeat=1):
+    '''Times the Gibbs kernels on one slab of slices of the first volume'''
+
+    slab= np.moveaxis(data[:, :, :options.get('slab_size', 16), 0], -1, 0)
+    slab= slab.astype(options.get('dtype', np.float64))
+    fft= get_fft_backend(options.get('fft_backend', 'numpy'), options.get('workers', 1))
+
+    results= []
+    t, peak, _= _timed(_image_tv, slab, 1, repeat=repeat)
+    results.append(('_image_tv', t, peak))
+    t, peak, _= _timed(_gibbs_removal_1d, slab, 1, repeat=repeat, fft=fft,
+                       real_fft=options.get('real_fft', False),
+                       shift_chunk=options.get('shift_chunk', 1),
+                       coarse_to_fine=options.get('coarse_to_fine', False),
+                       jit=options.get('jit', False))
+    results.append(('_gibbs_removal_1d', t, peak))
+    t, peak, _= _timed(_weights, slab.shape[1:], repeat=repeat)
+    results.append(('_weights', t, peak))
+
+    return slab.shape[0], results
+
+
+def compare(result, reference):
+    '''Maximum absolute and relative (to the reference maximum) differences'''
+
+    diff= np.abs(result-reference)
+    return diff.max(), diff.max()/np.abs(reference).max()
+
+
+def main(args):
+
+    shape= tuple(int(n) for n in args.shape.split('x'))
+    options= dict(slab_size= args.slab, shift_chunk= args.shift_chunk, real_fft= args.real_fft,
+                  fft_backend= args.fft, workers= args.threads, skip_constant= args.skip_background,
+                  dtype= np.float32 if args.float32 else np.float64, coarse_to_fine= args.coarse_to_fine,
+                  jit= args.jit)
+
+    data= ringing_phantom(shape, args.volumes, args.seed)
+    nslices= shape[2]*args.volumes
+    print('Phantom', 'x'.join(str(n) for n in data.shape), 'options', options)
+
+    nslab, kernels= benchmark_kernels(data, options, args.repeat)
+    print(f'\n{"kernel":<20}{"ms/slice":>12}{"peak MB":>12}')
+    for name, t, peak in kernels:
+        print(f'{name:<20}{1e3*t/nslab:>12.3f}{peak/1e6:>12.1f}')
+
+    t, peak, result= _timed(lambda: gibbs_removal(data.copy(), **options), repeat=args.repeat)
+    print(f'\ngibbs_removal {t:.2f} s, {nslices/t:.1f} slices/s, peak {peak/1e6:.1f} MB')
+
+    status= 0
+    if args.save_reference:
+        np.savez_compressed(args.save_reference, result=result, shape=shape, volumes=args.volumes,
+                            seed=args.seed)
+        print('Saved reference', args.save_reference)
+
+    if args.reference:
+        ref= np.load(args.reference)
+
+        # a reference made from another phantom is checked against the same options on that phantom
+        if tuple(ref['shape'])!=shape or ref['volumes']!=args.volumes or ref['seed']!=args.seed:
+            phantom= ringing_phantom(tuple(int(n) for n in ref['shape']), int(ref['volumes']), int(ref['seed']))
+            result= gibbs_removal(phantom, **options)
+
+        maxabs, maxrel= compare(result, ref['result'])
+        status= int(maxrel>args.tolerance)
+        print(f'Against {args.reference}: max abs diff {maxabs:.3g}, max rel diff {maxrel:.3g}',
+              'FAIL' if status else 'OK')
+
+    return status
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+        description="""Benchmark and accuracy regression of Gibbs unringing on a synthetic ringing phantom.
+Times gibbs_removal end to end and its kernels, reports throughput and peak traced memory,
+and compares the result with a reference saved by a previous run.""")
+
+    parser.add_argument('--shape', default='96x96x60', help='phantom size XxYxZ, default %(default)s')
+    parser.add_argument('--volumes', default=4, type=int, help='number of DWI-like volumes, default %(default)s')
+    parser.add_argument('--seed', default=0, type=int, help='random seed of the phantom, default %(default)s')
+    parser.add_argument('--repeat', default=1, type=int, help='number of timed runs, the best is reported')
+
+    parser.add_argument('--slab', default=16, type=int, help='gibbs_removal slab_size, default %(default)s')
+    parser.add_argument('--shift-chunk', default=1, type=int, help='gibbs_removal shift_chunk, default %(default)s')
+    parser.add_argument('--real-fft', action='store_true', help='use real-input FFTs')
+    parser.add_argument('--fft', default='numpy', choices=['auto', 'numpy', 'scipy', 'pyfftw'],
+                        help='FFT library, default %(default)s')
+    parser.add_argument('--threads', default=1, type=int, help='FFT threads, default %(default)s')
+    parser.add_argument('--skip-background', action='store_true', help='skip constant slices and rows')
+    parser.add_argument('--float32', action='store_true', help='compute in single precision')
+    parser.add_argument('--coarse-to-fine', action='store_true', help='use the coarse-to-fine shift search')
+    parser.add_argument('--jit', action='store_true', help='use the numba compiled TV and shift selection')
+
+    parser.add_argument('--save-reference', help='save the result to this .npz file')
+    parser.add_argument('--reference', default=REFERENCE,
+                        help='''compare the result with this .npz file saved by --save-reference, on the phantom
+it was made from, default the original implementation on a small phantom, '' to skip''')
+    parser.add_argument('--tolerance', default=1e-10, type=float,
+                        help='maximum difference with --reference, relative to its maximum, default %(default)s')
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -2,34 +2,175 @@
 
 from __future__ import print_function
 from os import getpid
-from util import logfmt, TemporaryDirectory, pjoin, FILEDIR, N_PROC, dirname
+from util import logfmt, TemporaryDirectory, pjoin, N_PROC, B0_THRESHOLD, dirname, load_xfms, \
+    rotate_bvecs, load_nifti
 from plumbum import local, cli, FG
-from plumbum.cmd import ls, flirt, fslmerge, tar, fslsplit
+from plumbum.cmd import ls, tar
 import numpy as np
 import sys
+import hashlib
+from functools import partial
 from multiprocessing import Pool
-from subprocess import check_call
-from conversion import read_bvecs, write_bvecs
+from conversion import read_bvals, read_bvecs, write_bvecs
+from affine_reg import register, apply_xfm, apply_xfms, Reference
+from nibabel import Nifti1Image
 
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
 
-def _Register_vol(volnii):
+# flirt options of the registration of each volume to the B0
+FLIRT_OPTIONS= ('-interp', 'sinc', '-sincwidth', '7', '-sincwindow', 'blackman', '-nosearch', '-paddingsize', '1')
 
-    logging.info('Run FSL flirt affine registration')
-    flirt('-interp' ,'sinc'
-          ,'-sincwidth' ,'7'
-          ,'-sincwindow' ,'blackman'
-          ,'-in', volnii
-          ,'-ref', 'b0.nii.gz'
-          ,'-nosearch'
-          ,'-o', volnii
-          ,'-omat', volnii.with_suffix('.txt', depth=2)
-          ,'-paddingsize', '1')
+# flirt options of the estimation of the transforms only, by --two-phase
+FLIRT_ESTIMATE_OPTIONS= ('-nosearch',)
+
+# options of the registration backends, part of the cache key
+BACKEND_OPTIONS= {'flirt': FLIRT_OPTIONS, 'python': ('affine_reg', 'mi', 'cubic')}
+ESTIMATE_OPTIONS= {'flirt': FLIRT_ESTIMATE_OPTIONS, 'python': ('affine_reg', 'mi')}
+
+# B0 preprocessed once by the main process and shared with the pool processes of --backend python
+_REFERENCE= None
+
+
+def _hash_image(filename):
+    '''sha256 of the voxel data and affine of an image, independent of its compression'''
+
+    img= load_nifti(filename)
+    h= hashlib.sha256(np.asanyarray(img.dataobj).tobytes())
+    h.update(img.affine.tobytes())
+
+    return h.hexdigest()
+
+
+def _share(reference):
+
+    global _REFERENCE
+    _REFERENCE= reference
+
+
+def _Register_python(volnii, omat, init=None, threads=1, estimate=False):
+
+    reference= _REFERENCE or Reference(load_nifti('b0.nii.gz'))
+    vol= load_nifti(volnii._path)
+
+    xfm= register(vol, reference, init= np.loadtxt(init) if init else None, ncpu= threads)
+    np.savetxt(omat, xfm, fmt= '%.10f')
+    if estimate:
+        return
+
+    b0= reference.img
+    hdr= b0.header.copy()
+    hdr.set_data_dtype(np.float32)
+    Nifti1Image(apply_xfm(vol, b0, xfm).astype(np.float32), b0.affine, hdr).to_filename(volnii._path)
+
+
+def _extract_b0(dwi, bvals):
+    '''Writes the first b0 of dwi to b0.nii.gz, as bse.py does by default'''
+
+    b0= np.nonzero(np.array(bvals, dtype= float)<B0_THRESHOLD)[0]
+    if not len(b0):
+        raise Exception('No b0 image found. Check the bval file.')
+    load_nifti(dwi).slicer[..., b0[0]].to_filename('b0.nii.gz')
+
+
+def _split_python(dwi, prefix):
+    '''Writes each volume of dwi to prefix0000.nii.gz, prefix0001.nii.gz, ...'''
+
+    img= load_nifti(dwi)
+    for i in range(img.shape[3]):
+        img.slicer[..., i].to_filename('{}{:04d}.nii.gz'.format(prefix, i))
+
+
+def _merge_python(vols, out):
+
+    first= load_nifti(vols[0]._path)
+    data= np.stack([load_nifti(vol._path).get_fdata(dtype= np.float32) for vol in vols], axis= 3)
+    Nifti1Image(data, first.affine, first.header).to_filename(out)
+
+
+def _Register_vol(volnii, init=None, cache=None, b0hash=None, backend='flirt', threads=1, estimate=False):
+    '''
+    Registers volnii to the B0, writing the transform to volnii.txt and the registered volume to volnii
+    unless only the transform is estimated
+    '''
+
+    omat= volnii.with_suffix('.txt', depth=2)
+    outputs= [omat] if estimate else [volnii, omat]
+    options= (ESTIMATE_OPTIONS if estimate else BACKEND_OPTIONS)[backend]
+
+    # transforms and registered volumes are cached by the hash of their inputs
+    if cache:
+        h= hashlib.sha256((_hash_image(volnii)+b0hash+' '.join(options)).encode())
+        if init:
+            h.update(np.loadtxt(init).tobytes())
+        cached= [local.path(cache) / (h.hexdigest()+''.join(f.suffixes)) for f in outputs]
+        if all(f.exists() for f in cached):
+            logging.info('Use cached registration of ' + volnii.name)
+            for src, dst in zip(cached, outputs):
+                src.copy(dst, override= True)
+            return volnii
+
+    if backend=='python':
+        logging.info('Run python affine registration')
+        _Register_python(volnii, omat, init, threads, estimate)
+    else:
+        from plumbum.cmd import flirt
+        logging.info('Run FSL flirt affine registration')
+        flirt(*options
+              ,'-in', volnii
+              ,'-ref', 'b0.nii.gz'
+              ,*([] if estimate else ['-o', volnii])
+              ,'-omat', omat
+              ,*(['-init', init] if init else []))
+
+    if cache:
+        # files are complete in the cache even if interrupted
+        for src, dst in zip(outputs, cached):
+            tmp= dst.with_name(str(getpid())+'-'+dst.name)
+            src.copy(tmp)
+            tmp.move(dst)
 
     return volnii
 
+
+def _Register_chain(vols, **options):
+    '''Registers vols one after the other, each one starting from the transform of the previous one'''
+
+    init= None
+    for volnii in vols:
+        _Register_vol(volnii, init, **options)
+        init= volnii.with_suffix('.txt', depth=2)
+
+    return vols
+
+
+def _warm_chains(vols, nproc, bvals=None):
+    '''
+    Splits vols into chains of consecutive volumes of balanced lengths, within the same shell if bvals are given.
+    There are nproc chains so that every process is busy, or fewer if there are fewer volumes,
+    or one per shell if there are more shells. Each shell gets a number of chains proportional to its size.
+    '''
+
+    if bvals is None:
+        groups= [list(range(len(vols)))]
+    else:
+        bvals= np.array(bvals, dtype= float)
+        shells= np.where(bvals<B0_THRESHOLD, 0, np.round(bvals/100)*100)
+        groups= [list(np.nonzero(shells==b)[0]) for b in np.unique(shells)]
+
+    nchains= min(nproc, len(vols))
+    sizes= np.array([len(group) for group in groups])
+    counts= np.maximum(1, nchains*sizes//sizes.sum())
+
+    # the remaining chains split the groups with the longest chains
+    while counts.sum()<nchains:
+        counts[np.argmax(sizes/counts)]+= 1
+
+    return [[vols[i] for i in chain] for group, count in zip(groups, counts)
+            for chain in np.array_split(group, count)]
+
+
 class App(cli.Application):
     '''Eddy current correction.'''
 
@@ -42,6 +183,23 @@ class App(cli.Application):
     nproc = cli.SwitchAttr(
         ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer 
         becomes sluggish/you run into memory error, reduce --nproc''', default= N_PROC)
+    warm = cli.SwitchAttr('--warm-start', cli.Set('none', 'time', 'shell'), default= 'none',
+        help='''initialize the registration of each volume with the transform of the previous volume in
+        acquisition order (time), or in its b-shell (shell), volumes are split into --nproc chains
+        of consecutive volumes of balanced lengths (at least one per shell), the first volume of each chain
+        starts from identity''')
+    cache = cli.SwitchAttr('--cache', help='''directory where the registration of each volume is cached,
+        keyed by a hash of the volume, the B0, and the flirt options, a rerun only registers
+        volumes that are new or changed''')
+    backend = cli.SwitchAttr('--backend', cli.Set('flirt', 'python'), default= 'flirt',
+        help='''register with FSL flirt, or in-process with NumPy/SciPy (affine_reg.py), maximizing the
+        mutual information over the B0 foreground and resampling with cubic B-splines,
+        python also dices and merges the DWI in-process and runs without FSL''')
+    threads = cli.SwitchAttr('--threads', int, default= 1,
+        help='number of threads of each --backend python registration')
+    two_phase = cli.Flag('--two-phase', default= False,
+        help='''estimate the transforms of all the volumes without resampling them, then resample the DWI
+        with all of them in one in-process pass of cubic B-splines on --nproc threads, written once''')
 
     def main(self):
         self.out = local.path(self.out)
@@ -53,6 +211,9 @@ class App(cli.Application):
                 sys.exit(1)
 
         outxfms = self.out.dirname / self.out.stem+'_xfms.tgz'
+        outxfmsArray = self.out.dirname / self.out.stem+'_xfms.npz'
+        if self.cache:
+            self.cache = local.path(self.cache)
 
         with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
             tmpdir = local.path(tmpdir)
@@ -60,19 +221,35 @@ class App(cli.Application):
             dicePrefix = 'vol'
 
             logging.info('Dice the DWI')
-            fslsplit[self.dwi] & FG
+            if self.backend=='python':
+                _split_python(self.dwi._path, dicePrefix)
+            else:
+                from plumbum.cmd import fslsplit
+                fslsplit[self.dwi] & FG
 
             logging.info('Extract the B0')
-            check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', self.dwi._path, 
-                                   '--bvals', self.bvalFile, '-o', 'b0.nii.gz']), shell= True)
+            _extract_b0(self.dwi._path, read_bvals(self.bvalFile._path))
 
             logging.info('Register each volume to the B0')
             vols = sorted(tmpdir // (dicePrefix + '*.nii.gz'))
 
             # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
-            res= pool.map_async(_Register_vol, vols)
-            volsRegistered= res.get()
+            options= dict(backend= self.backend, threads= self.threads, estimate= self.two_phase)
+            if self.cache:
+                local.path(self.cache).mkdir()
+                options.update(cache= local.path(self.cache), b0hash= _hash_image('b0.nii.gz'))
+
+            # the B0 is loaded, masked, and smoothed at every resolution level once for all the registrations
+            reference= Reference(load_nifti('b0.nii.gz')) if self.backend=='python' else None
+            pool= Pool(int(self.nproc), initializer= _share, initargs= (reference,))
+            if self.warm=='none':
+                res= pool.map_async(partial(_Register_vol, **options), vols)
+                volsRegistered= res.get()
+            else:
+                bvals= read_bvals(self.bvalFile._path) if self.warm=='shell' else None
+                res= pool.map_async(partial(_Register_chain, **options), _warm_chains(vols, int(self.nproc), bvals),
+                                    chunksize= 1)
+                volsRegistered= sorted(vol for chain in res.get() for vol in chain)
             pool.close()
             pool.join()
 
@@ -93,42 +270,34 @@ class App(cli.Application):
             #     volsRegistered.append(volnii)
 
 
-            fslmerge('-t', 'EddyCorrect-DWI.nii.gz', volsRegistered)
             transforms = tmpdir.glob(dicePrefix+'*.txt')
             transforms.sort()
+            xfms= load_xfms(transforms)
+
+            if self.two_phase:
+                logging.info('Resample the DWI with all the transforms')
+                dwi= load_nifti(self.dwi._path)
+                b0= reference.img if reference else load_nifti('b0.nii.gz')
+                hdr= dwi.header.copy()
+                hdr.set_data_dtype(np.float32)
+                Nifti1Image(apply_xfms(dwi, b0, xfms, ncpu= int(self.nproc)), b0.affine, hdr) \
+                    .to_filename('EddyCorrect-DWI.nii.gz')
+            elif self.backend=='python':
+                _merge_python(volsRegistered, 'EddyCorrect-DWI.nii.gz')
+            else:
+                from plumbum.cmd import fslmerge
+                fslmerge('-t', 'EddyCorrect-DWI.nii.gz', volsRegistered)
 
 
             logging.info('Extract the rotations and realign the gradients')
 
-            bvecs= read_bvecs(self.bvecFile._path)
-            bvecs_new= bvecs.copy()
-            for (i,t) in enumerate(transforms):
-
-                logging.info('Apply ' + t)
-                tra = np.loadtxt(t)
-
-                # removes the translation
-                aff = np.matrix(tra[0:3,0:3])
-
-                # computes the finite strain of aff to get the rotation
-                rot = aff*aff.T
-
-                # compute the square root of rot
-                [el, ev] = np.linalg.eig(rot)
-                eL = np.identity(3)*np.sqrt(el)
-                sq = ev*eL*ev.I
-
-                # finally the rotation is defined as
-                rot = sq.I*aff
-
-                bvecs_new[i] = np.dot(rot,bvecs[i]).tolist()[0]
-
-
+            bvecs_new= rotate_bvecs(read_bvecs(self.bvecFile._path), xfms)
 
             tar('cvzf', outxfms, transforms)
+            np.savez(outxfmsArray, xfms= xfms, names= [t.name for t in transforms])
 
             # save modified bvecs
-            write_bvecs(self.out._path+'.bvec', bvecs_new)
+            write_bvecs(self.out._path+'.bvec', bvecs_new.tolist())
 
             # save EddyCorrect-DWI
             local.path('EddyCorrect-DWI.nii.gz').copy(self.out._path+'.nii.gz')
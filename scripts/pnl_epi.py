@@ -77,6 +77,17 @@ class App(cli.Application):
             ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer 
             becomes sluggish/you run into memory error, reduce --nproc''', default= N_PROC)
 
+    engine = cli.SwitchAttr(
+            '--engine',
+            cli.Set('ants', 'python'),
+            default= 'ants',
+            help='''antsApplyTransformsDWI.py engine applying the warp to the DWI and its mask:
+            WarpImageMultiTransform on each volume, or in-process linear interpolation of all the volumes''')
+
+    jacobian = cli.Flag(
+            '--jacobian',
+            help='modulate the intensity of the corrected DWI by the Jacobian determinant of the warp, --engine python only')
+
     def main(self):
 
         self.out = local.path(self.out)
@@ -84,6 +95,10 @@ class App(cli.Application):
             logging.error('{} already exists, use --force to force overwrite.'.format(self.out))
             sys.exit(1)
 
+        if self.jacobian and self.engine!='python':
+            logging.error('--jacobian requires --engine python')
+            sys.exit(1)
+
 
         with TemporaryDirectory() as tmpdir:
             tmpdir = local.path(tmpdir)
@@ -124,9 +139,11 @@ class App(cli.Application):
 
             local.path(str(pre) + '0Warp.nii.gz').move(epiwarp)
 
-            logging.info('5. Apply warp to the DWI')
+            logging.info('5. Apply warp to the DWI and its mask')
+            epimask = self.out._path+'_mask.nii.gz'
             check_call((' ').join([pjoin(FILEDIR, 'antsApplyTransformsDWI.py'), '-i', self.dwi, '-m', self.dwimask,
-                                  '-t', epiwarp, '-o', dwiepi, '-n', self.nproc]), shell= True)
+                                  '-t', epiwarp, '-o', dwiepi, '--outmask', epimask, '--engine', self.engine,
+                                  '-n', self.nproc]+(['--jacobian'] if self.jacobian else [])), shell= True)
 
 
             # WarpTimeSeriesImageMultiTransform can also be used
@@ -134,12 +151,6 @@ class App(cli.Application):
             # fslmaths(self.dwi, '-mul', self.dwimask, dwimasked)
             # WarpTimeSeriesImageMultiTransform('4', dwimasked, dwiepi, '-R', dwimasked, '-i', epiwarp)
 
-            logging.info('6. Apply warp to the DWI mask')
-            epimask = self.out._path+'_mask.nii.gz'
-            antsApplyTransforms('-d', '3', '-i', self.dwimask, '-o', epimask,
-                                '-n', 'NearestNeighbor', '-r', bse, '-t', epiwarp)
-            fslmaths(epimask, '-mul', '1', epimask, '-odt', 'char')
-
 
             dwiepi.move(self.out._path+'.nii.gz')
             self.bvals_file.copy(self.out._path+'.bval')
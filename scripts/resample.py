@@ -5,30 +5,305 @@ from nibabel import load, save, Nifti1Image
 from os.path import abspath, isfile
 from shutil import copyfile
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from functools import partial
 from glob import glob
 from plumbum import local, FG
-from plumbum.cmd import fslsplit, fslmerge
-from plumbum.cmd import ResampleImage
 import signal
 from tempfile import TemporaryDirectory
 import argparse
 import numpy as np
+from math import comb, factorial
+from scipy.sparse import csr_matrix
+from scipy.ndimage import affine_transform, spline_filter1d, find_objects
 
 N_CPU= 4
 
-def _resample_dwi(vol):
+# ResampleImage interpolation types supported by --engine scipy and corresponding spline orders
+SPLINE_ORDER= {0: 1, 1: 0, 4: 5}
+
+# fraction of pairs of neighbor foreground voxels with the same value above which an integer image is a label map
+LABEL_UNIFORMITY= 0.8
+
+# edge padding of images before B-spline prefiltering, as scipy.ndimage does for mode='nearest'
+SPLINE_PAD= 12
+
+
+def _size_spacing(size):
+    '''ResampleImage flag, 1 if all of MxNxO are larger than 5 hence dimensions, 0 if they are spacing'''
+
+    return '1' if np.array([float(x)>5 for x in size.strip().split('x')]).all() else '0'
+
+
+def _is_label_map(img):
+    '''
+    A mask or a label map is stored as unscaled integers, or as floats of integer values, and most pairs of
+    its neighbor foreground voxels have the same value. Only every 8th slice is checked.
+    '''
+
+    if img.header['dim'][0]!=3:
+        return False
+
+    slope, inter= img.header.get_slope_inter()
+    if slope not in (None, 1) or inter not in (None, 0):
+        return False
+
+    sample= np.asanyarray(img.dataobj[..., ::8])
+    if not np.issubdtype(sample.dtype, np.integer) and not np.array_equal(sample, np.round(sample)):
+        return False
+
+    same= sample[1:]==sample[:-1]
+    foreground= (sample[1:]!=0) | (sample[:-1]!=0)
+
+    return not foreground.any() or same[foreground].mean()>=LABEL_UNIFORMITY
+
+
+def _resample_dwi(vol, size, size_spacing, order):
+
+    from plumbum.cmd import ResampleImage
 
     print('Resampling', vol)
 
     ResampleImage('3', vol, vol.replace('.nii.gz', '_re.nii.gz'),
-                  args.size, args.size_spacing,
-                  args.order, '5' if args.order == 4 else '')
+                  size, size_spacing,
+                  order, '5' if order == 4 else '')
 
 def RAISE(ERR):
     raise ERR
 
-def main():
-    
+
+def resample_grid(img, size):
+    '''
+    Output shape and affine of resampling img to MxNxO size or, if not all of M,N,O>5, resolution.
+    As ResampleImage, the first voxel stays in place, so does the last one to within a voxel.
+    Also returns the scaling of voxel indices from the output to the input grid.
+    '''
+
+    insize= np.array(img.shape[:3])
+    inspacing= np.array(img.header.get_zooms()[:3], dtype= float)
+    size= np.array([float(x) for x in size.strip().split('x')])
+
+    if (size>5).all():
+        shape= size.astype(int)
+        spacing= inspacing*(insize-1)/np.maximum(shape-1, 1)
+    else:
+        spacing= size
+        shape= ((insize-1)*inspacing/spacing+1e-6).astype(int)+1
+
+    scale= spacing/inspacing
+    affine= img.affine.copy()
+    affine[:3, :3]= affine[:3, :3]*scale
+
+    return tuple(shape), affine, scale
+
+
+def _resample_volume(data, shape, scale, order):
+
+    return affine_transform(data, scale, output_shape= shape, order= order, mode= 'nearest',
+                            prefilter= order>1, output= np.float32)
+
+
+def _bspline(t, n):
+    '''Centered B-spline of degree n at t'''
+
+    t= np.abs(t)
+    b= np.zeros(t.shape)
+    for k in range(n+2):
+        b+= (-1)**k*comb(n+1, k)*np.maximum(t+(n+1)/2-k, 0)**n
+
+    return b/factorial(n)
+
+
+def _interp_weights(n, x, order):
+    '''
+    Indices and weights of the points of a line of n points interpolating it at coordinates x,
+    by nearest neighbor (order 0), linearly (order 1), or by B-spline of its prefiltered coefficients
+    '''
+
+    if order==0:
+        ind= np.floor(x+0.5).astype(int)[:, None]
+        w= np.ones(ind.shape)
+    elif order==1:
+        ind= np.floor(x).astype(int)[:, None]+np.arange(2)
+        w= 1-np.abs(x[:, None]-ind)
+    else:
+        ind= np.floor(x-(order+1)/2).astype(int)[:, None]+1+np.arange(order+1)
+        w= _bspline(x[:, None]-ind, order)
+
+        # mirror boundary of the coefficients
+        period= max(2*n-2, 1)
+        ind= np.abs(ind) % period
+        ind= np.where(ind>n-1, period-ind, ind)
+
+    return np.clip(ind, 0, n-1), w
+
+
+def _csr(ind, w, n):
+
+    return csr_matrix((w.ravel(), ind.ravel(), np.arange(0, ind.size+1, ind.shape[1])), shape= (len(ind), n))
+
+
+def _apply_separable(ops, data):
+    '''Applies sparse matrices ops along the first axes of data, one product per axis'''
+
+    for axis, op in enumerate(ops):
+        data= np.moveaxis(data, axis, 0)
+        lines= data.shape[1:]
+        data= np.moveaxis((op @ data.reshape(data.shape[0], -1)).reshape((-1,)+lines), 0, axis)
+
+    return data
+
+
+class SparseResampler(object):
+    '''
+    Resampling from a grid of inshape to a grid of shape, where output voxel indices scaled by scale
+    are input voxel indices, computed once as sparse matrices and applied to all volumes at once.
+    order is the spline order, 0 (nearest neighbor), 1 (linear) or >1 (B-spline of the prefiltered image).
+    The result is that of scipy.ndimage.affine_transform with mode='nearest' to rounding.
+
+    The matrices interpolate along one axis each, from the input points they use only. Given a boolean
+    mask of shape, they only compute the output voxels of the bounding box of the mask, then those
+    outside the mask are set to 0.
+    '''
+
+    def __init__(self, inshape, shape, scale, order, mask=None):
+
+        self.shape= tuple(shape)
+        self.order= order
+        self.pad= SPLINE_PAD if order>1 else 0
+        self.inshape= tuple(n+2*self.pad for n in inshape[:3])
+
+        self.mask= mask
+        self.box= tuple(slice(0, n) for n in self.shape)
+        if mask is not None:
+            vox= np.nonzero(mask)
+            self.box= tuple(slice(v.min(), v.max()+1) if len(v) else slice(0, 0) for v in vox)
+
+        # rows of the output points in the box, columns of the span of input points they use
+        self.crop= []
+        self.ops= []
+        for a, n in enumerate(self.inshape):
+            ind, w= _interp_weights(n, scale[a]*np.arange(shape[a])[self.box[a]]+self.pad, order)
+            first, last= (ind.min(), ind.max()+1) if ind.size else (0, 0)
+            self.crop.append(slice(first, last))
+            self.ops.append(_csr(ind-first, w, last-first))
+        self.crop= tuple(self.crop)
+
+
+    def apply(self, data):
+        '''Resamples 3D data or all volumes of 4D data'''
+
+        # nothing to interpolate for an empty mask
+        if any(b.start==b.stop for b in self.box):
+            return np.zeros(self.shape+data.shape[3:])
+
+        volumes= data.ndim==4
+        if not volumes:
+            data= data[..., None]
+
+        if self.order>1:
+            data= np.pad(np.asarray(data, dtype= float), [(self.pad, self.pad)]*3+[(0, 0)], mode= 'edge')
+            for axis in (2, 1, 0):
+                data= spline_filter1d(data, self.order, axis= axis, mode= 'mirror')
+                # the next axes are only filtered along the lines of the points used on this one
+                data= data[(slice(None),)*axis+(self.crop[axis],)]
+        else:
+            data= data[self.crop]
+
+        data= _apply_separable(self.ops, np.asarray(data, dtype= float))
+
+        if self.mask is not None:
+            resampled= np.zeros(self.shape+(data.shape[3],))
+            resampled[self.box]= data*self.mask[self.box][..., None]
+            data= resampled
+
+        return data if volumes else data[..., 0]
+
+
+def resample_inprocess(img, size, order, ncpu=N_CPU, sparse=False, mask=None):
+    '''
+    Resamples 3D or 4D img with scipy, the output grid is computed once and applied to all volumes
+    by a pool of ncpu threads, or if sparse, by sparse matrices to all volumes at once.
+    order is the ResampleImage interpolation type. The sparse resampling can be restricted to a mask of img.
+    '''
+
+    if order not in SPLINE_ORDER:
+        raise ValueError(f'--engine {"sparse" if sparse else "scipy"} supports --order '
+                         f'{", ".join(str(o) for o in SPLINE_ORDER)}, not {order}')
+
+    shape, affine, scale= resample_grid(img, size)
+    data= img.get_fdata(dtype= np.float32)
+
+    if sparse:
+        if mask is not None:
+            mask= SparseResampler(mask.shape, shape, scale, 0).apply(mask)>0
+        resampled= SparseResampler(img.shape, shape, scale, SPLINE_ORDER[order], mask).apply(data)
+        resampled= resampled.astype(np.float32)
+
+    elif data.ndim==3:
+        resampled= _resample_volume(data, shape, scale, SPLINE_ORDER[order])
+
+    else:
+        resampled= np.empty(shape+(data.shape[3],), dtype= np.float32)
+
+        def _resample(vol):
+            print('Resampling volume', vol)
+            resampled[..., vol]= _resample_volume(data[..., vol], shape, scale, SPLINE_ORDER[order])
+
+        pool= ThreadPool(ncpu)
+        try:
+            pool.map(_resample, range(data.shape[3]))
+        finally:
+            pool.close()
+            pool.join()
+
+    hdr= img.header.copy()
+    hdr.set_data_dtype(np.float32)
+
+    return Nifti1Image(resampled, affine= affine, header= hdr)
+
+
+def resample_labels(img, size, generic=False):
+    '''
+    Resamples label map img keeping its data type, by nearest neighbor or, if generic, by picking
+    for every output voxel the label whose indicator has the largest linear interpolation
+    '''
+
+    shape, affine, scale= resample_grid(img, size)
+    labels= np.asanyarray(img.dataobj)
+
+    if generic:
+        ops= [_csr(*_interp_weights(n, scale[a]*np.arange(shape[a]), 1), n) for a, n in enumerate(labels.shape)]
+        values, inverse= np.unique(labels, return_inverse= True)
+        resampled= np.zeros(shape, dtype= labels.dtype)
+        best= np.full(shape, -1.)
+
+        # each label is only interpolated in the output block its bounding box reaches
+        for label, box in zip(values, find_objects(inverse.reshape(labels.shape)+1)):
+            rows= [np.unique(op[:, sl].nonzero()[0]) for op, sl in zip(ops, box)]
+            if not all(r.size for r in rows):
+                # too small to reach any output voxel
+                continue
+            block= tuple(slice(r[0], r[-1]+1) for r in rows)
+            block_ops= [op[b, sl] for op, b, sl in zip(ops, block, box)]
+
+            w= _apply_separable(block_ops, (labels[box]==label).astype(float))
+            upd= w>best[block]
+            resampled[block][upd]= label
+            best[block][upd]= w[upd]
+
+    else:
+        ind= [_interp_weights(n, scale[a]*np.arange(shape[a]), 0)[0][:, 0] for a, n in enumerate(labels.shape)]
+        resampled= labels[np.ix_(*ind)]
+
+    hdr= img.header.copy()
+    hdr.set_data_dtype(labels.dtype)
+
+    return Nifti1Image(resampled, affine= affine, header= hdr)
+
+
+def main(args):
+
     filename= abspath(args.input)
     outPrefix= abspath(args.outPrefix)
     if not isfile(filename):
@@ -36,9 +311,34 @@ def main():
 
     img= load(filename)
 
-    args.size_spacing= '1' if np.array([float(x)>5 for x in args.size.strip().split('x')]).all() else '0'
+    size_spacing= _size_spacing(args.size)
+    order= int(args.order)
+
+    # masks and label maps keep their data type
+    if _is_label_map(img):
+        print('Resampling label map', filename)
+
+        if args.engine=='ants' and args.labels=='nearest':
+            from plumbum.cmd import ResampleImage
+
+            ResampleImage('3', args.input, outPrefix+'.nii.gz', args.size, size_spacing,
+                          '1', '2')
+            resampled= load(outPrefix+'.nii.gz')
+            labels= np.rint(resampled.get_fdata()).astype(img.get_data_dtype())
+            hdr= resampled.header.copy()
+            hdr.set_data_dtype(labels.dtype)
+            Nifti1Image(labels, affine= resampled.affine, header= hdr).to_filename(outPrefix+'.nii.gz')
+
+        else:
+            resample_labels(img, args.size, args.labels=='generic').to_filename(outPrefix+'.nii.gz')
+
+    elif args.engine in ['scipy', 'sparse']:
+        mask= load(args.mask).get_fdata()>0 if args.mask else None
+        resample_inprocess(img, args.size, order, args.ncpu, args.engine=='sparse', mask).to_filename(outPrefix+'.nii.gz')
+
+    elif img.header['dim'][0]==4:
+        from plumbum.cmd import fslsplit, fslmerge
 
-    if img.header['dim'][0]==4:
         # DWI
         with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
 
@@ -56,7 +356,8 @@ def main():
             pool= Pool(args.ncpu)
             signal.signal(signal.SIGINT, sigint_handler)
             try:
-                pool.map_async(_resample_dwi, volumes, error_callback=RAISE)
+                pool.map_async(partial(_resample_dwi, size= args.size, size_spacing= size_spacing, order= order),
+                               volumes, error_callback=RAISE)
             except KeyboardInterrupt:
                 pool.terminate()
             else:
@@ -70,21 +371,18 @@ def main():
             print('Merging 3Ds')
             fslmerge['-t', outPrefix+'.nii.gz', volumes] & FG
 
+    # T1w/T2w
+    else:
+        from plumbum.cmd import ResampleImage
+
+        ResampleImage('3', args.input, outPrefix+'.nii.gz', args.size, size_spacing,
+                      order, '5' if order==4 else '')
+
+    if img.header['dim'][0]==4:
         inPrefix= filename.split('.nii')[0]
         copyfile(inPrefix+'.bval', outPrefix+'.bval')
         copyfile(inPrefix+'.bvec', outPrefix+'.bvec')
 
-    else:
-        # mask
-        if sum(np.unique(img.get_fdata()))==1:
-            ResampleImage('3', args.input, outPrefix+'.nii.gz', args.size, args.size_spacing,
-                          '1', '2')
-
-        # T1w/T2w
-        else:
-            ResampleImage('3', args.input, outPrefix+'.nii.gz', args.size, args.size_spacing,
-                          args.order, '5' if args.order==4 else '')
-
 
 
 if __name__=='__main__':
@@ -107,9 +405,22 @@ if all of M,N,O<5, it is interpreted as resolution""")
                         help="""For details about order of interpolation, see ResampleImage --help, 
 the default for masks is 1 (nearest neighbor) while for all other images it is 4 (Bspline [order=5])""")
 
-    args = parser.parse_args()
+    parser.add_argument('--engine', default='ants', choices=['ants', 'scipy', 'sparse'],
+                        help="""ants runs ResampleImage on each 3D volume, scipy resamples all volumes in process
+with --ncpu threads without splitting and merging 4D images, sparse computes the interpolation weights once
+as sparse matrices and applies them to all volumes at once, faster for many volumes at the expense of RAM,
+scipy and sparse support --order 0 (linear), 1, and 4""")
+
+    parser.add_argument('--labels', default='nearest', choices=['nearest', 'generic'],
+                        help="""interpolation of masks and label maps, detected from an integer data type and uniform
+neighbor values, which keep their data type: nearest neighbor, or generic picks the label of largest linearly
+interpolated indicator, smoother but slower, always computed in process, default %(default)s""")
 
-    main()
+    parser.add_argument('--mask',
+                        help='''mask of the input, --engine sparse only computes the output in the bounding box
+of the mask, faster and with less RAM than without it, 0 outside the mask''')
 
+    args = parser.parse_args()
 
+    main(args)
 
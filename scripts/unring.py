@@ -1,89 +1,258 @@
 #!/usr/bin/env python
 
-import sys
-from gibbs import gibbs_removal
+from gibbs import gibbs_removal, get_fft_backend, GibbsWorkspace
 from nibabel import load, save, Nifti1Image
 # from util import save_nifti
-from os.path import abspath, isfile
-from shutil import copyfile
+from os.path import abspath, isfile, join as pjoin
+from shutil import copyfile, copyfileobj
 from multiprocessing import Pool
-from glob import glob
-from plumbum import local, FG
-from plumbum.cmd import fslsplit, fslmerge
+from functools import partial
+from plumbum import local
 import signal
 from tempfile import TemporaryDirectory
+import argparse
+import gzip
+import os
+import numpy as np
 
+N_CPU= 4
+# maximum number of slices unringed at a time by a process of --stream
+SLAB= 16
 
-def _unring(vol):
-    
-    print('unringing', vol)
+# buffers of gibbs_removal reused by all the volumes or slabs unringed by a process
+WORKSPACE= GibbsWorkspace()
 
-    img= load(vol)
-    unringed= gibbs_removal(img.get_fdata())
-    
-    outPrefix= vol.split('.nii')[0]+ '_ur'
-    
-    new_image= Nifti1Image(unringed, affine= img.affine, header= img.header)
+# 4D image and mask loaded once by the main process and shared with the pool processes
+_DWI= None
+_MASK= None
+
+
+def _wisdom_file():
+    '''File of the FFTW plans measured by one run and reused by the next ones'''
+
+    return pjoin(os.getenv('PNLPIPE_TMPDIR', pjoin(os.path.expanduser('~'), 'tmp')), 'fftw_wisdom.npz')
+
+
+def _gibbs_options(fft='numpy', threads=1, skip_background=False, float32=False,
+                   coarse_to_fine=False, jit=False):
+    '''Keyword arguments of gibbs_removal corresponding to the command line options and the shared mask'''
+
+    # the wisdom file is only resolved for a backend that may be pyfftw
+    wisdom= _wisdom_file() if fft in ('auto', 'pyfftw') else None
+
+    return dict(fft_backend= get_fft_backend(fft, threads, wisdom),
+                mask= _MASK,
+                skip_constant= skip_background,
+                dtype= np.float32 if float32 else np.float64,
+                coarse_to_fine= coarse_to_fine,
+                jit= jit,
+                workspace= WORKSPACE)
+
+
+def _share(dwi, mask):
+
+    global _DWI, _MASK
+    _DWI= dwi
+    _MASK= mask
+
+
+def _unring(vol, **options):
+
+    print('unringing volume', vol)
+
+    options= _gibbs_options(**options)
+
+    return vol, gibbs_removal(_DWI[..., vol], out= np.empty(_DWI.shape[:3], options['dtype']), **options)
+
+
+def _unring_volumes(filename, outPrefix, ncpu, mask, options):
+
+    img= load(filename)
+    dwi= img.get_fdata(dtype= np.float32 if options['float32'] else np.float64)
+
+    # the pool processes receive the DWI and the mask once, unringed volumes are written back into it
+    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool= Pool(ncpu, initializer= _share, initargs= (dwi, mask))
+    signal.signal(signal.SIGINT, sigint_handler)
+    try:
+        for vol, unringed in pool.imap_unordered(partial(_unring, **options), range(dwi.shape[3])):
+            dwi[..., vol]= unringed
+    except KeyboardInterrupt:
+        # no output is written from a partly unringed DWI
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+
+    new_image= Nifti1Image(dwi, affine= img.affine, header= img.header)
     new_image.to_filename(outPrefix+'.nii.gz')
 
 
 
-def main():
-    
-    filename= abspath(sys.argv[1])
-    outPrefix= abspath(sys.argv[2])
+def _unring_slab(task, infile, outfile, **options):
+
+    vol, first, last= task
+    if vol is None:
+        print('unringing slices', first, 'to', last-1)
+        idx= (slice(None), slice(None), slice(first, last))
+    else:
+        print('unringing volume', vol, 'slices', first, 'to', last-1)
+        idx= (slice(None), slice(None), slice(first, last), vol)
+
+    # both files are uncompressed, only the slab is read from and written to disk
+    img= load(infile, mmap= True)
+    out= np.load(outfile, mmap_mode= 'r+')
+    options= _gibbs_options(**options)
+    if options['mask'] is not None:
+        options['mask']= options['mask'][:, :, first:last]
+
+    gibbs_removal(img.dataobj[idx], out= out[idx], **options)
+    out.flush()
+
+
+def _slab_tasks(shape, ncpu, slab=SLAB):
+    '''
+    (volume, first slice, last slice) tasks covering a 3D (volume None) or 4D image,
+    in slabs of at most slab slices, small enough for at least two tasks per process
+    '''
+
+    nvol= shape[3] if len(shape)==4 else 1
+    slab= max(1, min(slab, int(np.ceil(shape[2]*nvol/(2*ncpu)))))
+    volumes= range(shape[3]) if len(shape)==4 else [None]
+
+    return [(vol, first, min(first+slab, shape[2]))
+            for vol in volumes for first in range(0, shape[2], slab)]
+
+
+def _unring_stream(filename, outPrefix, ncpu, mask, options):
+
+    # an uncompressed copy of the input can be read one slab at a time
+    if filename.endswith('.gz'):
+        infile= abspath('dwi.nii')
+        with gzip.open(filename) as fin, open(infile, 'wb') as fout:
+            copyfileobj(fin, fout)
+    else:
+        infile= filename
+
+    img= load(infile, mmap= True)
+    shape= img.shape
+    outfile= abspath('dwi_ur.npy')
+    # in the voxel order of NIfTI, so that a slab of slices of a volume is contiguous on disk
+    np.lib.format.open_memmap(outfile, mode= 'w+', dtype= np.float32, shape= shape, fortran_order= True)
+
+    # slabs are handed out one at a time to whichever process is free, the mask is received once
+    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool= Pool(ncpu, initializer= _share, initargs= (None, mask))
+    signal.signal(signal.SIGINT, sigint_handler)
+    try:
+        for _ in pool.imap_unordered(partial(_unring_slab, infile= infile, outfile= outfile, **options),
+                                     _slab_tasks(shape, ncpu), chunksize= 1):
+            pass
+    except KeyboardInterrupt:
+        # no output is written from a partly unringed memmap
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+
+    # saved with the data type of the input, as _unring_volumes does
+    new_image= Nifti1Image(np.load(outfile, mmap_mode= 'r'), affine= img.affine, header= img.header)
+    new_image.to_filename(outPrefix+'.nii.gz')
+
+
+
+def main(args):
+
+    filename= abspath(args.dwi)
+    outPrefix= abspath(args.outPrefix)
     if not isfile(filename):
         raise FileNotFoundError(f'{filename} does not exist')
-    
-    
+    mask= load(args.mask).get_fdata()>0 if args.mask else None
+
+    shape= load(filename).shape
+    if len(shape) not in (3, 4):
+        raise ValueError(f'{filename} is neither a 3D nor a 4D image')
+
+
     with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
-        
+
         tmpdir= local.path(tmpdir)
 
         print('Working directory', tmpdir)
-        
-        fslsplit(filename, 'dwi', '-t')
-        
-        volumes= glob('dwi*.nii.gz')
-        volumes.sort()
-
-        sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        
-        try:
-            N_CPU= int(sys.argv[3])
-        except:
-            N_CPU= 4
-
-        pool= Pool(N_CPU)
-        signal.signal(signal.SIGINT, sigint_handler)
-        try:
-            pool.map_async(_unring, volumes)
-        except KeyboardInterrupt:
-            pool.terminate()
+
+        options= dict(fft= args.fft, threads= args.threads,
+                      skip_background= args.skip_background, float32= args.float32,
+                      coarse_to_fine= args.coarse_to_fine, jit= args.jit)
+
+        # 3D images and DWIs with fewer volumes than processes are split into slabs of slices too,
+        # so that every process has work
+        if args.stream or len(shape)==3 or shape[3]<args.ncpu:
+            _unring_stream(filename, outPrefix, args.ncpu, mask, options)
+
         else:
-            pool.close()
-        pool.join()
-        
-        
-        volumes= glob('dwi*_ur.nii.gz')
-        volumes.sort()
-        fslmerge['-t', outPrefix+'.nii.gz', volumes] & FG
+            _unring_volumes(filename, outPrefix, args.ncpu, mask, options)
 
-    inPrefix= filename.split('.nii')[0] 
+    if len(shape)==4:
+        _copy_gradients(filename, outPrefix)
+
+
+def _copy_gradients(filename, outPrefix):
+
+    inPrefix= filename.split('.nii')[0]
     copyfile(inPrefix+'.bval', outPrefix+'.bval')
     copyfile(inPrefix+'.bvec', outPrefix+'.bvec')
 
 
 if __name__=='__main__':
-    if len(sys.argv)==1 or sys.argv[1]=='-h' or sys.argv[1]=='--help':
-        print('Usage:\n'
-              'unring.py <dwi> <outPrefix> <ncpu>\n'
-              'Gibbs unringing of all DWI gradients using DIPY\n'
-              'Default ncpu=4, you can increase it at the expense of RAM\n')
-        exit()
 
+    parser = argparse.ArgumentParser(
+        description='Gibbs unringing of all DWI gradients, or of a 3D image, using DIPY')
+
+    parser.add_argument('dwi', help='input DWI, or 3D image such as a T1w or T2w')
+    parser.add_argument('outPrefix', help='unringed image and, for a DWI, corresponding bval/bvec are saved with outPrefix')
+
+    parser.add_argument('ncpu', nargs='?', default= N_CPU, type= int,
+                        help='''number of processes, default %(default)s, you can increase it at the expense of RAM,
+3D images and DWIs with fewer gradients than ncpu are processed in slabs of slices as with --stream''')
+
+    parser.add_argument('--threads', default= 1, type= int,
+                        help="""number of FFT threads per process, default %(default)s,
+threads share the memory of their process unlike ncpu""")
+
+    parser.add_argument('--fft', default='auto', choices=['auto', 'numpy', 'scipy', 'pyfftw'],
+                        help="""FFT library, default %(default)s picks pyfftw, scipy, or numpy in that order
+of availability, numpy ignores --threads""")
+
+    parser.add_argument('--mask',
+                        help='''mask of the DWI, slices and rows of slices outside it are passed through unchanged,
+this also changes the result inside the mask by up to about 0.2%% of the maximum intensity, use
+--skip-background instead for identical output''')
+
+    parser.add_argument('--skip-background', action='store_true',
+                        help="""pass all-zero or constant slices and rows of slices through unchanged
+without processing them, this does not change the result""")
+
+    parser.add_argument('--float32', action='store_true',
+                        help="""compute in single precision, halves RAM per process so that more ncpu fit
+in memory, differences with double precision are mostly below 1e-4 of the maximum intensity""")
+
+    parser.add_argument('--coarse-to-fine', action='store_true',
+                        help="""search 9 instead of 45 sub-voxel shifts and refine the best one by interpolation,
+about twice faster, differences with the full search relative to the maximum intensity are below 0.3%% for
+99%% of the voxels and 1.2%% for 99.9%%, up to 7%% at a few voxels near sharp edges""")
 
-    main()
+    parser.add_argument('--jit', action='store_true',
+                        help="""compile the TV and sub-voxel shift selection with numba if it is installed,
+same result in less time, otherwise this option is ignored""")
 
+    parser.add_argument('--stream', action='store_true',
+                        help="""read and unring slabs of slices one at a time from an uncompressed copy of
+the DWI into a memory-mapped float32 output, RAM does not grow with the number of gradients""")
 
+    args = parser.parse_args()
 
+    main(args)
@@ -25,6 +25,7 @@ if not TMPDIR.exists():
 
 
 from nibabel import load as load_nifti, Nifti1Image
+import numpy as np
 
 
 def save_nifti(fname, data, affine, hdr=None):
@@ -39,6 +40,30 @@ def save_nifti(fname, data, affine, hdr=None):
     result_img.to_filename(fname)
 
 
+def load_xfms(files):
+    '''Stacks the 4x4 affine transform text files into an (N, 4, 4) array'''
+
+    return np.array([np.loadtxt(f) for f in files]).reshape(-1, 4, 4)
+
+
+def xfm_rotations(xfms):
+    '''
+    Rotations of (N, 4, 4) or (N, 3, 3) affine transforms, without their translation and finite strain.
+    The rotation R of the polar decomposition A = (A A^T)^(1/2) R of each linear part A is U V^T
+    where A = U S V^T is its singular value decomposition.
+    '''
+
+    u, _, vt= np.linalg.svd(np.asarray(xfms)[:, :3, :3])
+
+    return u @ vt
+
+
+def rotate_bvecs(bvecs, xfms):
+    '''Rotates every bvec by the rotation of its volume's affine transform, returns an (N, 3) array'''
+
+    return np.einsum('nij,nj->ni', xfm_rotations(xfms), np.asarray(bvecs, dtype= float))
+
+
 def logfmt(scriptname):
     return '%(asctime)s ' + scriptname + ' %(levelname)s  %(message)s'
 